@@ -3,32 +3,108 @@ Parse a XML wiktionary dump using a SAX parser (humongous file!).
 Produces another smaller XML files containing only the english words with their id and the full text. (4 GB => 400 MB)
 By default, only words present in the previous frequency list (resource/my_english_frequency_list.csv) are included.
 @see https://dumps.wikimedia.org/backup-index.html
+
+To run the program:
+$ python 4-parse_wiktionary.py
+
+The dump could also be split into shards parsed in parallel (one process per core by default):
+$ python 4-parse_wiktionary.py --jobs 0
+
+Most pages are not in english. These pages are skipped at the byte level before reaching the SAX parser.
+Use --no-prefilter to parse every page.
+
+The compressed multistream dump could be read directly (no need to extract the archive first).
+The streams listed in the index file are decompressed in parallel by the worker processes:
+$ python 4-parse_wiktionary.py --jobs 0 \\
+    --source resources/enwiktionary-20160720-pages-articles-multistream.xml.bz2 \\
+    --index resources/enwiktionary-20160720-pages-articles-multistream-index.txt.bz2
+
+A small multistream dump could be generated from an uncompressed dump (useful for testing):
+$ python 4-parse_wiktionary.py --make-multistream resources/enwiktionary-multistream.xml.bz2
+
+Sorted indexes title => page id, offset and length are saved next to the dump (generated during the first run)
+and next to the output file (ex: resources/mywiktionary.xml.idx). The dump index allows to reextract a few words
+without parsing the whole dump:
+$ python 4-parse_wiktionary.py --lookup book car
+
+A manifest (title, page id, revision id, sha1) of the extracted words is also saved (resources/mywiktionary.xml.manifest).
+When using a new dump, the incremental mode compares the revisions with the previous manifest and saves only
+the new or modified entries (resources/mywiktionary.changes.xml) and the removed words (resources/mywiktionary.removed.txt)
+so that the next script could only reparse these entries (see 5-parse_mytionary.py --incremental):
+$ python 4-parse_wiktionary.py --incremental --source resources/enwiktionary-20170101.xml
+
+The entries could be saved in a SQLite database instead of a XML file (no XML parsing required by the next script):
+$ python 4-parse_wiktionary.py --output resources/mywiktionary.db
 """
 
 import xml.sax
+import xml.sax.saxutils
+import bz2
 import codecs
+import heapq
+import multiprocessing
+import os
+import sqlite3
+import tempfile
 
 
 duplicates = {}
 
+# Index of the output file (see IndexWriter)
+output_index = None
+
+# Revisions of the words appended to the output file: title => (page id, revision id, sha1)
+output_manifest = None
+
+# Database replacing the output file when using the SQLite format (see DictionaryDatabase)
+output_database = None
+
+# Size of the chunks read when searching a <page> boundary or feeding the SAX parser
+CHUNK_SIZE = 1024 * 1024
+
+# Number of shards per process (smaller shards balance better the work between processes)
+SHARDS_PER_JOB = 4
+
+# Number of pages per stream when generating a multistream dump (same as Wikimedia)
+PAGES_PER_STREAM = 100
+
+# Number of entries inserted at once in the SQLite output
+DATABASE_BATCH_SIZE = 1000
+
+# Number of index entries kept in memory before being sorted and saved to a temporary file
+INDEX_RUN_SIZE = 1000000
+
+# The handler searches the english section among the first 200 characters of the text.
+# Raw bytes are still escaped (ex: &quot;) so we search in a larger window to never miss a word.
+TEXT_PREFIX_BYTES = 200 * 10
+
 
 class ABContentHandler(xml.sax.ContentHandler):
 
-    def __init__(self, frequency_list=None):
+    def __init__(self, frequency_list=None, verbose=True):
         xml.sax.ContentHandler.__init__(self)
         self.frequency_list = frequency_list
+        self.verbose = verbose
 
         # Flag to determine our current position inside the XML file
         self.in_page = False
         self.in_id = False
         self.in_title = False
         self.in_text = False
+        self.in_revision = False
+        self.in_contributor = False
+        self.in_sha1 = False
 
         # Variables to hold informations about the currently processed element
         self.id = None
         self.title = None
         self.text = None
 
+        # Revision of the current element (the <id> of the page is not always the last one found)
+        self.page_id = None
+        self.revision_id = None
+        self.sha1 = None
+
         # Counter to count the number of english word found
         self.filtered_words = 0
         self.all_words = 0
@@ -36,8 +112,22 @@ class ABContentHandler(xml.sax.ContentHandler):
     def startElement(self, name, attrs):
         if name == "page":
             self.in_page = True
+            self.page_id = None
+            self.revision_id = None
+            self.sha1 = None
+        if self.in_page and name == "revision":
+            self.in_revision = True
+        if self.in_page and name == "contributor":
+            self.in_contributor = True
+        if self.in_page and name == "sha1":
+            self.in_sha1 = True
+            self.sha1 = ""
         if self.in_page and name == "id":
             self.in_id = True
+            if not self.in_revision:
+                self.page_id = ""
+            elif not self.in_contributor:
+                self.revision_id = ""
         if self.in_page and name == "title":
             self.in_title = True
         if self.in_page and name == "text":
@@ -48,30 +138,25 @@ class ABContentHandler(xml.sax.ContentHandler):
         if self.in_title:
             self.title = content
             # Give feedback to user
-            print("%s... [%s/%s]" % (self.title, self.filtered_words, self.all_words))
+            if self.verbose:
+                print("%s... [%s/%s]" % (self.title, self.filtered_words, self.all_words))
         elif self.in_id:
             self.id = content
+            if not self.in_revision:
+                self.page_id += content
+            elif not self.in_contributor:
+                self.revision_id += content
         elif self.in_text:
             self.text += content
+        elif self.in_sha1:
+            self.sha1 += content
+
+    def _get_revision(self):
+        return self.page_id, self.revision_id, self.sha1
 
-    def _append_word(self):
-        global output_file
-        self.filtered_words += 1
-        if self.frequency_list:
-            self.frequency_list[self.title] = True
-        output_file.write("  <entry>\n")
-        output_file.write("    <id>%s</id>\n" % self.id)
-        output_file.write("    <title>%s</title>\n" % self.title)
-        output_file.write("    <text xml:space=\"preserve\"><![CDATA[\n")
-        output_file.write("%s\n" % self.text)
-        output_file.write("    ]]></text>\n")
-        output_file.write("  </entry>\n")
-
-    def _mark_as_duplicate(self):
-        global duplicates
-        if self.title not in duplicates:
-            duplicates[self.title] = []
-        duplicates[self.title].append(self.id)
+    def _register_word(self):
+        if register_word(self.frequency_list, self.id, self.title, self.text, self._get_revision()):
+            self.filtered_words += 1
 
     def endElement(self, name):
         if name == "page":
@@ -85,14 +170,7 @@ class ABContentHandler(xml.sax.ContentHandler):
             if "==English==" in self.text[:200] \
                     and ":" not in self.title \
                     and self.title != self.title.title():
-
-                if not self.frequency_list:
-                    self._append_word()
-                elif self.title in self.frequency_list:
-                    if self.frequency_list[self.title]:  # Previously found?
-                        self._mark_as_duplicate()
-                    else:
-                        self._append_word()
+                self._register_word()
 
         if self.in_page and name == "title":
             self.in_title = False
@@ -100,27 +178,842 @@ class ABContentHandler(xml.sax.ContentHandler):
             self.in_id = False
         if self.in_page and name == "text":
             self.in_text = False
+        if self.in_page and name == "revision":
+            self.in_revision = False
+        if self.in_page and name == "contributor":
+            self.in_contributor = False
+        if self.in_page and name == "sha1":
+            self.in_sha1 = False
+
+
+class ShardContentHandler(ABContentHandler):
+    """
+    Handler used to parse a single shard of the dump in a worker process.
+    Duplicates could only be detected when knowing all the previous shards,
+    so the filtered words are kept in memory and registered later in order by the main process.
+    """
+
+    def __init__(self, frequency_list=None):
+        ABContentHandler.__init__(self, frequency_list, verbose=False)
+        self.words = []
+
+    def _register_word(self):
+        if not self.frequency_list or self.title in self.frequency_list:
+            self.filtered_words += 1
+            self.words.append((self.id, self.title, self.text, self._get_revision()))
+
+
+def _append_word(id, title, text, revision=None):
+    global output_file
+    global output_index
+    global output_manifest
+    global output_database
+    if output_database:
+        output_database.add(id, title, text)
+    else:
+        if output_index:
+            offset = output_file.tell()
+        output_file.write(
+            "  <entry>\n"
+            "    <id>%s</id>\n"
+            "    <title>%s</title>\n"
+            "    <text xml:space=\"preserve\"><![CDATA[\n"
+            "%s\n"
+            "    ]]></text>\n"
+            "  </entry>\n" % (id, title, text))
+    if output_index:
+        # The <id> of the entry is the last one found (revision or contributor), the index maps the title to the page
+        page_id = revision[0] if revision else id
+        output_index.add(title.encode("utf-8"), page_id.encode("ascii"), offset, output_file.tell() - offset)
+    if output_manifest is not None and revision:
+        output_manifest[title] = revision
+
+
+def _mark_as_duplicate(title, id):
+    global duplicates
+    if title not in duplicates:
+        duplicates[title] = []
+    duplicates[title].append(id)
+
+
+def register_word(frequency_list, id, title, text, revision=None):
+    """
+    Append an english word to the output file unless the word is not common or was previously found.
+    Words must be registered in the order of the dump for the duplicates to be reported consistently.
+    :param revision: the optional (page id, revision id, sha1) to save in the manifest
+    :return: True if the word was appended
+    """
+    if not frequency_list:
+        _append_word(id, title, text, revision)
+        return True
+    elif title in frequency_list:
+        if frequency_list[title]:  # Previously found?
+            _mark_as_duplicate(title, id)
+        else:
+            frequency_list[title] = True
+            _append_word(id, title, text, revision)
+            return True
+    return False
+
+
+def _find_next(source, offset, marker):
+    """
+    Search the first occurrence of the marker after the given offset.
+    :param source: the dump opened in binary mode
+    :return: the offset of the marker or None if not found
+    """
+    source.seek(offset)
+    previous = b""
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            return None
+        data = previous + chunk
+        index = data.find(marker)
+        if index >= 0:
+            return offset - len(previous) + index
+        # Keep the end of the chunk in case the marker overlaps two chunks
+        previous = data[-len(marker):]
+        offset += len(chunk)
+
+
+def _find_last(source, size, marker):
+    """
+    Search the last occurrence of the marker by reading the dump backwards.
+    :param source: the dump opened in binary mode
+    :return: the offset of the marker or None if not found
+    """
+    end = size
+    following = b""
+    while end > 0:
+        start = max(0, end - CHUNK_SIZE)
+        source.seek(start)
+        data = source.read(end - start) + following
+        index = data.rfind(marker)
+        if index >= 0:
+            return start + index
+        following = data[:len(marker)]
+        end = start
+    return None
+
+
+def find_shards(source_filename, count):
+    """
+    Split the dump into byte ranges aligned on <page> boundaries.
+    The header (<siteinfo>) and the closing tag </mediawiki> are excluded so that each range contains only pages.
+    :param source_filename: the XML dump
+    :param count: the requested number of shards (fewer shards are returned for small dumps)
+    :return: the list of (start, end) offsets
+    """
+    size = os.path.getsize(source_filename)
+    with open(source_filename, "rb") as source:
+        first = _find_next(source, 0, b"<page>")
+        if first is None:  # No page at all
+            return []
+        last = _find_last(source, size, b"</page>") + len(b"</page>")
+
+        boundaries = [first]
+        for i in range(1, count):
+            offset = _find_next(source, first + (last - first) * i // count, b"<page>")
+            if offset is None or offset >= last:
+                break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+        boundaries.append(last)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_chunks(source, start=0, end=None):
+    """
+    Read the dump by chunks.
+    :param source: the dump opened in binary mode
+    :param start: the offset of the first byte to read
+    :param end: the offset after the last byte to read (None to read until EOF)
+    :return: a generator of bytes
+    """
+    source.seek(start)
+    remaining = end - start if end is not None else None
+    while remaining is None or remaining > 0:
+        size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        chunk = source.read(size)
+        if not chunk:
+            break
+        yield chunk
+        if remaining is not None:
+            remaining -= len(chunk)
+
+
+def read_multistream_index(index_filename):
+    """
+    Read the index published with the multistream dump.
+    Each line follows the format offset:page_id:title where offset is the position of the stream containing the page.
+    :return: the sorted list of the stream offsets
+    """
+    opener = bz2.open if is_compressed(index_filename) else open
+    offsets = set()
+    with opener(index_filename, "rt", encoding="utf-8") as index:
+        for line in index:
+            offsets.add(int(line[:line.index(':')]))
+    return sorted(offsets)
+
+
+def find_stream_shards(source_filename, index_filename, count):
+    """
+    Same as #find_shards for the compressed multistream dump. Ranges are aligned on the streams listed in the index.
+    The first stream (the header <siteinfo>) is excluded and the last range includes the stream closing </mediawiki>.
+    """
+    offsets = read_multistream_index(index_filename)
+    if not offsets:
+        return []
+    size = os.path.getsize(source_filename)
+
+    boundaries = [offsets[0]]
+    streams_per_shard = max(1, len(offsets) // count)
+    for i in range(streams_per_shard, len(offsets), streams_per_shard):
+        boundaries.append(offsets[i])
+    boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def write_multistream(source_filename, target_filename, index_filename, pages_per_stream=PAGES_PER_STREAM):
+    """
+    Generate a compressed multistream dump and its index from an uncompressed dump, following the Wikimedia layout:
+    one stream for the header, one stream for every group of pages, and a last stream for the closing tag.
+    """
+    opener = bz2.open if is_compressed(index_filename) else open
+    with open(source_filename, "rb") as source, open(target_filename, "wb") as target, \
+            opener(index_filename, "wt", encoding="utf-8") as index:
+
+        # Search the end of the header
+        header = b""
+        for chunk in read_chunks(source):
+            header += chunk
+            if b"<page>" in header:
+                break
+        header = header[:header.find(b"<page>")].rstrip(b" ")
+        target.write(bz2.compress(header))
+
+        pages = []
+        for offset, page in iter_pages(read_chunks(source, len(header))):
+            pages.append(page)
+            if len(pages) == pages_per_stream:
+                _write_stream(target, index, pages)
+                pages = []
+        if pages:
+            _write_stream(target, index, pages)
+
+        target.write(bz2.compress(b"</mediawiki>\n"))
+
+
+def _unescape_title(raw_title):
+    return xml.sax.saxutils.unescape(raw_title.decode("utf-8"), {"&quot;": '"', "&#039;": "'"})
+
+
+def _write_stream(target, index, pages):
+    offset = target.tell()
+    for page in pages:
+        page_id = _get_page_id(page).decode("ascii")
+        index.write("%s:%s:%s\n" % (offset, page_id, _unescape_title(_get_raw_title(page))))
+    target.write(bz2.compress(b"  " + b"\n  ".join(pages) + b"\n"))
+
+
+def decompress_chunks(chunks):
+    """
+    Decompress a sequence of bz2 streams (the multistream dump is a concatenation of independent streams).
+    :param chunks: the compressed bytes
+    :return: a generator of decompressed bytes
+    """
+    decompressor = bz2.BZ2Decompressor()
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if decompressor.eof:  # Next stream
+                chunk = decompressor.unused_data
+                decompressor = bz2.BZ2Decompressor()
+            else:
+                chunk = b""
+
+
+def is_compressed(source_filename):
+    return source_filename.endswith(".bz2")
+
+
+def read_dump(source, source_filename, start=0, end=None):
+    """
+    Same as #read_chunks but decompress the content when reading a multistream dump.
+    The range must be aligned on streams when the dump is compressed.
+    """
+    chunks = read_chunks(source, start, end)
+    if is_compressed(source_filename):
+        chunks = decompress_chunks(chunks)
+    return chunks
+
+
+def iter_pages(chunks, offset=0):
+    """
+    Split the raw dump into pages without parsing the XML.
+    The text is escaped inside the dump so the tags <page> and </page> could not appear inside the content.
+    :param chunks: the bytes of the dump
+    :param offset: the offset of the first chunk
+    :return: a generator of (offset, raw <page>...</page> bytes)
+    """
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        position = 0
+        while True:
+            begin = buffer.find(b"<page>", position)
+            if begin < 0:
+                # Keep the end in case the tag overlaps two chunks
+                position = max(position, len(buffer) - len(b"<page>"))
+                break
+            end = buffer.find(b"</page>", begin)
+            if end < 0:  # Incomplete page
+                position = begin
+                break
+            position = end + len(b"</page>")
+            yield offset + begin, buffer[begin:position]
+        buffer = buffer[position:]
+        offset += position
+
+
+def _get_raw_title(page):
+    title_start = page.find(b"<title>") + len(b"<title>")
+    return page[title_start:page.find(b"</title>", title_start)]
+
+
+def _get_page_id(page):
+    """ Return the page id (the first <id> is the id of the page, the next ones are the revision and the user ids). """
+    id_start = page.find(b"<id>") + len(b"<id>")
+    return page[id_start:page.find(b"</id>", id_start)]
+
+
+def is_candidate(page, frequency_list=None):
+    """
+    Check at the byte level if a raw page could be kept by ABContentHandler.
+    The test is conservative: the filters are only applied when the raw bytes are enough to decide,
+    the remaining pages are checked again by the handler.
+    :param page: the raw <page>...</page> bytes
+    :param frequency_list: the optional frequency list
+    :return: False if the page is known to be ignored by the handler
+    """
+    # Remove non-english words
+    text_start = page.find(b"<text")
+    if text_start < 0:
+        return False
+    text_start = page.find(b">", text_start) + 1
+    if b"==English==" not in page[text_start:text_start + TEXT_PREFIX_BYTES]:
+        return False
+
+    # Titles with entities (ex: &amp;) are reported in several parts by the SAX parser, let the handler decides
+    raw_title = _get_raw_title(page)
+    if b"&" in raw_title:
+        return True
 
+    title = raw_title.decode("utf-8")
+    if ":" in title or title == title.title():
+        return False
+    if frequency_list and title not in frequency_list:
+        return False
 
-def main(source_filename, frequency_list):
-    """ Entry point. """
-    source = open(source_filename)
-    xml.sax.parse(source, ABContentHandler(frequency_list))
+    return True
+
+
+def parse_pages(pages, handler, frequency_list=None, prefilter=True, index_writer=None):
+    """
+    Send only the candidate pages to the SAX handler.
+    :param pages: the raw pages with their offsets (see #iter_pages)
+    :param handler: the SAX handler
+    :param frequency_list: the optional frequency list
+    :param prefilter: False to send all pages to the handler
+    :param index_writer: the optional IndexWriter to register all pages (parsed or not)
+    :return: the number of pages skipped without being parsed
+    """
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(handler)
+
+    skipped = 0
+
+    # The pages are enclosed inside a fake root element to get a well-formed document
+    parser.feed(b"<pages>")
+    for offset, page in pages:
+        if index_writer:
+            title = _unescape_title(_get_raw_title(page)).encode("utf-8")
+            index_writer.add(title, _get_page_id(page), offset, len(page))
+        if not prefilter or is_candidate(page, frequency_list):
+            parser.feed(page)
+        else:
+            skipped += 1
+    parser.feed(b"</pages>")
+    parser.close()
+
+    return skipped
+
+
+class IndexWriter:
+    """
+    Write a sorted index title => (page id, offset, length) using a bounded memory.
+    Entries are sorted by runs saved into temporary files, and the runs are merged at the end (see #merge_index).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = []
+        self.runs = []
+
+    def add(self, title, page_id, offset, length):
+        """ Register a new entry (title and page_id are bytes). """
+        self.entries.append(b"%s\t%s\t%d\t%d\n" % (title, page_id, offset, length))
+        if len(self.entries) >= INDEX_RUN_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Save the pending entries into a new run.
+        :return: the filenames of all the runs
+        """
+        if self.entries:
+            self.entries.sort()
+            fd, run_filename = tempfile.mkstemp(prefix="index-", suffix=".run", dir=self.directory)
+            with os.fdopen(fd, "wb") as run:
+                run.writelines(self.entries)
+            self.runs.append(run_filename)
+            self.entries = []
+        return self.runs
+
+
+def merge_index(run_filenames, index_filename):
+    """
+    Merge the sorted runs into the final index file. Each line follows the format title\tpage_id\toffset\tlength.
+    Runs are removed afterwards.
+    """
+    runs = [open(run_filename, "rb") for run_filename in run_filenames]
+    try:
+        with open(index_filename, "wb") as index:
+            index.writelines(heapq.merge(*runs))
+    finally:
+        for run in runs:
+            run.close()
+        for run_filename in run_filenames:
+            os.remove(run_filename)
+
+
+def write_multistream_title_index(source_filename, multistream_index_filename, index_filename):
+    """
+    Convert the index of the multistream dump into our sorted index.
+    Pages could not be located inside a compressed dump, so the offset and the length are those of the stream.
+    The multistream index is sorted by offset: only the entries of the current stream are kept in memory,
+    until the offset of the next stream gives its length.
+    """
+    index_writer = IndexWriter(os.path.dirname(os.path.abspath(index_filename)))
+
+    def add_stream(entries, offset, next_offset):
+        for (page_id, title) in entries:
+            index_writer.add(title.encode("utf-8"), page_id.encode("ascii"), offset, next_offset - offset)
+
+    stream_offset = None
+    stream_entries = []
+    opener = bz2.open if is_compressed(multistream_index_filename) else open
+    with opener(multistream_index_filename, "rt", encoding="utf-8") as multistream_index:
+        for line in multistream_index:
+            (offset, page_id, title) = line.rstrip("\n").split(":", 2)
+            offset = int(offset)
+            if offset != stream_offset:
+                if stream_entries:
+                    add_stream(stream_entries, stream_offset, offset)
+                stream_offset = offset
+                stream_entries = []
+            stream_entries.append((page_id, title))
+
+    if stream_entries:  # The last stream ends with the dump
+        add_stream(stream_entries, stream_offset, os.path.getsize(source_filename))
+    merge_index(index_writer.flush(), index_filename)
+
+
+def search_index(index_filename, title):
+    """
+    Search a title using a binary search inside the sorted index.
+    :return: the list of (page_id, offset, length) (could contain several pages when the title is duplicated)
+    """
+    key = title.encode("utf-8")
+    result = []
+    with open(index_filename, "rb") as index:
+        # Search the first line whose title is greater or equal than the key
+        low = 0
+        high = os.path.getsize(index_filename)
+        while low < high:
+            middle = (low + high) // 2
+            if middle > 0:  # Go to the beginning of the next line
+                index.seek(middle - 1)
+                index.readline()
+            else:
+                index.seek(0)
+            line = index.readline()
+            if not line or line[:line.index(b"\t")] >= key:
+                high = middle
+            else:
+                low = middle + 1
+
+        if low > 0:
+            index.seek(low - 1)
+            index.readline()
+        else:
+            index.seek(0)
+        for line in index:
+            (line_title, page_id, offset, length) = line.rstrip(b"\n").split(b"\t")
+            if line_title != key:
+                break
+            result.append((page_id.decode("ascii"), int(offset), int(length)))
+    return result
+
+
+def lookup_pages(source_filename, index_filename, titles):
+    """
+    Read only the pages of the given titles using the index.
+    :return: the list of (offset, raw page)
+    """
+    pages = []
+    with open(source_filename, "rb") as source:
+        for title in titles:
+            for (page_id, offset, length) in search_index(index_filename, title):
+                if is_compressed(source_filename):
+                    # Decompress the whole stream (100 pages) to find the page
+                    for page_offset, page in iter_pages(read_dump(source, source_filename, offset, offset + length)):
+                        if _get_page_id(page).decode("ascii") == page_id:
+                            pages.append((offset, page))
+                else:
+                    source.seek(offset)
+                    pages.append((offset, source.read(length)))
+    return pages
+
+
+def lookup_entries(output_filename, titles):
+    """
+    Same as #lookup_pages for the output file (ex: resources/mywiktionary.xml) using its index.
+    :return: the list of raw <entry>...</entry> (bytes)
+    """
+    entries = []
+    with open(output_filename, "rb") as output:
+        for title in titles:
+            for (page_id, offset, length) in search_index(output_filename + ".idx", title):
+                output.seek(offset)
+                entries.append(output.read(length))
+    return entries
+
+
+def extract_words(source_filename, index_filename, titles):
+    """
+    Reextract a few words from the dump without reading the whole file.
+    The same filters are applied (english words only, etc.) except the frequency list.
+    :return: the list of (id, title, text, (page id, revision id, sha1))
+    """
+    handler = ShardContentHandler()
+    parse_pages(lookup_pages(source_filename, index_filename, titles), handler, prefilter=False)
+    return handler.words
+
+
+def read_manifest(manifest_filename):
+    """
+    Read the manifest saved by a previous run.
+    :return: a dictionary title => (page id, revision id, sha1)
+    """
+    manifest = {}
+    for line in codecs.open(manifest_filename, "r", "utf-8"):
+        (title, page_id, revision_id, sha1) = line.rstrip("\n").split("\t")
+        manifest[title] = (page_id, revision_id, sha1)
+    return manifest
+
+
+def write_manifest(manifest_filename, manifest):
+    """ Save the manifest sorted by title. Each line follows the format title\tpage_id\trevision_id\tsha1. """
+    with codecs.open(manifest_filename, "w", "utf-8") as output:
+        for title in sorted(manifest):
+            output.write("%s\t%s\t%s\t%s\n" % ((title,) + manifest[title]))
+
+
+def compare_manifests(previous_manifest, manifest):
+    """
+    Search the words modified between two dumps.
+    :return: the sorted lists of the new or modified titles, and of the removed titles
+    """
+    modified = [title for title in manifest if previous_manifest.get(title) != manifest[title]]
+    removed = [title for title in previous_manifest if title not in manifest]
+    return sorted(modified), sorted(removed)
+
+
+def write_changes(output_filename, modified, removed):
+    """
+    Save the new or modified entries into a smaller dictionary, and the removed words into a text file.
+    The entries are copied from the output file using its index.
+    """
+    (basename, extension) = os.path.splitext(output_filename)
+    changes_filename = basename + ".changes" + extension
+
+    if is_database(output_filename):
+        changes = DictionaryDatabase(changes_filename)
+        for (id, title, text) in DictionaryDatabase.lookup(output_filename, modified):
+            changes.add(id, title, text)
+        changes.close()
+    else:
+        with open(changes_filename, "wb") as changes:
+            changes.write(b"<dictionary>\n")
+            for entry in lookup_entries(output_filename, modified):
+                changes.write(entry)
+            changes.write(b"</dictionary>\n")
+
+    with codecs.open(basename + ".removed.txt", "w", "utf-8") as removed_file:
+        for title in removed:
+            removed_file.write("%s\n" % title)
+
+
+def is_database(output_filename):
+    return output_filename.endswith(".db")
+
+
+class DictionaryDatabase:
+    """
+    Alternative to the XML output file. Entries are inserted by batches inside a SQLite table
+    so that the next script could iterate over them (or search a title) without parsing XML.
+    """
+
+    def __init__(self, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.connection = sqlite3.connect(filename)
+        # The database is regenerated from scratch when something goes wrong
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("CREATE TABLE entry (position INTEGER PRIMARY KEY, id TEXT, title TEXT, text TEXT)")
+        self.batch = []
+
+    def add(self, id, title, text):
+        self.batch.append((id, title, text))
+        if len(self.batch) >= DATABASE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.connection.executemany("INSERT INTO entry (id, title, text) VALUES (?, ?, ?)", self.batch)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.connection.execute("CREATE INDEX entry_title ON entry (title)")
+        self.connection.commit()
+        self.connection.close()
+
+    @staticmethod
+    def lookup(filename, titles):
+        """
+        Search the entries of the given titles.
+        :return: the list of (id, title, text) in the order of the database
+        """
+        connection = sqlite3.connect(filename)
+        try:
+            entries = []
+            for title in titles:
+                entries.extend(connection.execute(
+                    "SELECT id, title, text FROM entry WHERE title = ? ORDER BY position", (title,)))
+            return entries
+        finally:
+            connection.close()
+
+
+def _init_worker(frequency_list):
+    global shard_frequency_list
+    shard_frequency_list = frequency_list
+
+
+def _parse_shard(shard):
+    """
+    Parse a range of the dump in a worker process.
+    :param shard: a tuple (source_filename, start, end, prefilter, index_directory).
+                  Offsets are aligned on streams for compressed dumps.
+                  The index is not generated when the index directory is None.
+    :return: the number of pages read, the list of (id, title, text, revision) of the filtered words, and the index runs
+    """
+    source_filename, start, end, prefilter, index_directory = shard
+
+    handler = ShardContentHandler(shard_frequency_list)
+    index_writer = IndexWriter(index_directory) if index_directory else None
+    with open(source_filename, "rb") as source:
+        pages = iter_pages(read_dump(source, source_filename, start, end), start)
+        skipped = parse_pages(pages, handler, shard_frequency_list, prefilter, index_writer)
+
+    runs = index_writer.flush() if index_writer else []
+    return handler.all_words + skipped, handler.words, runs
+
+
+def main_sharded(source_filename, frequency_list, jobs, prefilter=True, index_filename=None, title_index_filename=None):
+    """
+    Same as #main but the dump is split into shards parsed in parallel.
+    Shards are merged in order to report the same duplicates as the serial mode.
+    :param index_filename: the index of the streams (required when the dump is compressed)
+    :param title_index_filename: the sorted index of the titles to generate (None to skip)
+    """
+    if is_compressed(source_filename):
+        shards = find_stream_shards(source_filename, index_filename, jobs * SHARDS_PER_JOB)
+    else:
+        shards = find_shards(source_filename, jobs * SHARDS_PER_JOB)
+
+    # The index of a compressed dump is converted from the multistream index instead
+    index_directory = None
+    if title_index_filename and not is_compressed(source_filename):
+        index_directory = os.path.dirname(os.path.abspath(title_index_filename))
+    tasks = [(source_filename, start, end, prefilter, index_directory) for (start, end) in shards]
+    runs = []
+
+    all_words = 0
+    filtered_words = 0
+    pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(frequency_list,))
+    try:
+        # imap() returns the results in order while the next shards are still being processed
+        for i, (shard_all_words, words, shard_runs) in enumerate(pool.imap(_parse_shard, tasks)):
+            all_words += shard_all_words
+            runs.extend(shard_runs)
+            for (id, title, text, revision) in words:
+                if register_word(frequency_list, id, title, text, revision):
+                    filtered_words += 1
+            # Give feedback to user
+            print("Shard %s/%s... [%s/%s]" % (i + 1, len(tasks), filtered_words, all_words))
+    finally:
+        pool.close()
+        pool.join()
+
+    if index_directory:
+        merge_index(runs, title_index_filename)
+
+
+def main(source_filename, frequency_list, prefilter=True, title_index_filename=None):
+    """
+    Entry point.
+    :param prefilter: search the english pages at the byte level before parsing them (much faster)
+    :param title_index_filename: the sorted index of the titles to generate (None to skip)
+    """
+    if title_index_filename and not is_compressed(source_filename):
+        index_writer = IndexWriter(os.path.dirname(os.path.abspath(title_index_filename)))
+    else:
+        index_writer = None
+
+    if prefilter or index_writer or is_compressed(source_filename):
+        with open(source_filename, "rb") as source:
+            handler = ABContentHandler(frequency_list)
+            pages = iter_pages(read_dump(source, source_filename))
+            skipped = parse_pages(pages, handler, frequency_list, prefilter, index_writer)
+            print("%s pages skipped by the prefilter" % skipped)
+        if index_writer:
+            merge_index(index_writer.flush(), title_index_filename)
+    else:
+        source = open(source_filename)
+        xml.sax.parse(source, ABContentHandler(frequency_list))
 
 
 if __name__ == "__main__":
 
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--source", help="Wiktionary XML dump", default="resources/enwiktionary.xml")
+    parser.add_argument("-o", "--output", help="Output XML file (or SQLite database when ending with .db)",
+                        default="resources/mywiktionary.xml")
+    parser.add_argument("-j", "--jobs", help="Number of processes to parse the dump in shards (0 = one per core)",
+                        type=int, default=1)
+    parser.add_argument("--no-prefilter", help="Parse all pages with the SAX parser (slower)",
+                        action="store_false", dest="prefilter")
+    parser.add_argument("-i", "--index", help="Index of the multistream dump (default: deduced from the source)")
+    parser.add_argument("--make-multistream", help="Compress the source into a multistream dump and exit",
+                        metavar="TARGET")
+    parser.add_argument("--lookup", help="Print the entries of the given words using the index of the dump and exit",
+                        nargs="+", metavar="WORD")
+    parser.add_argument("--incremental", help="Save the entries modified since the previous run in a separate file",
+                        action="store_true")
+    args = parser.parse_args()
+
+    if args.make_multistream:
+        index_filename = args.make_multistream.replace(".xml.bz2", "-index.txt.bz2")
+        write_multistream(args.source, args.make_multistream, index_filename)
+        print("Generated %s (index: %s)" % (args.make_multistream, index_filename))
+        sys.exit(0)
+
+    index_filename = args.index
+    if not index_filename and is_compressed(args.source):
+        index_filename = args.source.replace(".xml.bz2", "-index.txt.bz2")
+
+    # The sorted index of the dump is only generated once (or when the dump is replaced)
+    title_index_filename = args.source + ".idx"
+    if os.path.exists(title_index_filename) \
+            and os.path.getmtime(title_index_filename) >= os.path.getmtime(args.source):
+        build_title_index = False
+    elif is_compressed(args.source) and os.path.exists(index_filename):
+        write_multistream_title_index(args.source, index_filename, title_index_filename)
+        build_title_index = False
+    else:
+        build_title_index = not is_compressed(args.source)
+
+    if args.lookup:
+        if build_title_index:
+            print("Missing index %s. Run the program once without --lookup to generate it." % title_index_filename)
+            sys.exit(1)
+        output_file = codecs.getwriter("utf-8")(sys.stdout.buffer)
+        output_index = None
+        for (id, title, text, revision) in extract_words(args.source, title_index_filename, args.lookup):
+            _append_word(id, title, text)
+        sys.exit(0)
+
     # (Optional) Read the frequency to filter the words
     frequency_list = {}
     for line in codecs.open("my_english_frequency_list.csv", "r", "utf-8"):
         (rank, word) = line.strip().split(',')
         frequency_list[word] = False
 
-    output_file = codecs.open("resources/mywiktionary.xml", "w", "utf-8")
-    output_file.write("<dictionary>\n")
-    main("resources/enwiktionary.xml", frequency_list)
-    output_file.write("</dictionary>\n")
-    output_file.close()
+    jobs = args.jobs or multiprocessing.cpu_count()
+    if jobs > 1 and is_compressed(args.source) and not os.path.exists(index_filename):
+        # Streams could not be located without the index, decompress the dump sequentially
+        print("Missing index %s. Falling back to the serial mode..." % index_filename)
+        jobs = 1
+
+    # The previous manifest must be read before being overwritten
+    manifest_filename = args.output + ".manifest"
+    previous_manifest = None
+    if args.incremental:
+        if os.path.exists(manifest_filename):
+            previous_manifest = read_manifest(manifest_filename)
+        else:
+            print("Missing manifest %s. All entries will be considered as new." % manifest_filename)
+            previous_manifest = {}
+
+    output_manifest = {}
+    if is_database(args.output):
+        # Titles are already indexed inside the database
+        output_database = DictionaryDatabase(args.output)
+    else:
+        output_file = codecs.open(args.output, "w", "utf-8")
+        output_index = IndexWriter(os.path.dirname(os.path.abspath(args.output)))
+        output_file.write("<dictionary>\n")
+
+    if jobs > 1:
+        main_sharded(args.source, frequency_list, jobs, args.prefilter, index_filename,
+                     title_index_filename if build_title_index else None)
+    else:
+        main(args.source, frequency_list, args.prefilter, title_index_filename if build_title_index else None)
+
+    if output_database:
+        output_database.close()
+    else:
+        output_file.write("</dictionary>\n")
+        output_file.close()
+        merge_index(output_index.flush(), args.output + ".idx")
+    write_manifest(manifest_filename, output_manifest)
+
+    if previous_manifest is not None:
+        (modified, removed) = compare_manifests(previous_manifest, output_manifest)
+        write_changes(args.output, modified, removed)
+        print("-------------------")
+        print("%s new or modified word(s), %s removed word(s)" % (len(modified), len(removed)))
 
     # (Optional) Check that we found all the words present in our frequency list
     print("-------------------")
@@ -2,15 +2,66 @@
 
 """
 Parse the custom XML dictionary using a SAX parser.
+
+To run the program:
+$ python 5-parse_mytionary.py
+
+After running 4-parse_wiktionary.py --incremental on a new dump, only the new or modified entries
+need to be parsed. The previous resources/mywiktionary.json is patched in place:
+$ python 5-parse_mytionary.py --incremental
+
+The entries could also be read from the SQLite database generated by 4-parse_wiktionary.py (faster):
+$ python 5-parse_mytionary.py --input resources/mywiktionary.db
+
+Entries are independent and could be parsed in parallel (one process per core by default):
+$ python 5-parse_mytionary.py --jobs 0
+
+The words could be written as soon as they are parsed into resources/mywiktionary.jsonl (one word per line)
+instead of being kept in memory until the end:
+$ python 5-parse_mytionary.py --format jsonl
+
+The results of the parsing could be cached to speed up the next runs (only the blocks whose parser version
+changed in BLOCK_VERSIONS are parsed again):
+$ python 5-parse_mytionary.py --cache
+
+The images and audio files referenced by the words are listed in resources/mywiktionary.media.tsv.
+
+To compare the wiki syntax converter with its previous implementation:
+$ python 5-parse_mytionary.py --benchmark xwiki2html
+
+To measure the number of entries parsed per second:
+$ python 5-parse_mytionary.py --benchmark sections
 """
 
 
 import xml.sax
 import codecs
-import io
+import functools
 import json
 import re
 import hashlib
+import heapq
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+
+
+# Number of entries sent at once to a worker process
+BATCH_SIZE = 100
+
+# Size of the chunks read when feeding the SAX parser
+CHUNK_SIZE = 1024 * 1024
+
+# Width (in pixels) of the thumbnails of the images
+THUMB_WIDTH = 600
+
+# Number of parsing results saved at once into the cache (--cache)
+CACHE_BATCH_SIZE = 1000
+
+# Number of words sorted in memory before being saved into a temporary run (--format jsonl)
+SORT_RUN_SIZE = 10000
 
 
 def read_frequency_list():
@@ -37,6 +88,7 @@ def _hashname(filename):
 
     return filename
 
+@functools.lru_cache(maxsize=65536)
 def _wikimedia_hashpath(filename):
     filename = _hashname(filename)
     filename = filename.encode('utf-8')
@@ -70,15 +122,231 @@ def to_wikimedia_thumb_url(filename, width):
     return url
 
 
+def _image_properties(link):
+    """
+    :param link: the image link without the Image: prefix. Ex: Pieni2.jpg|thumb|A hard-cover book
+    :return: the image's dictionary
+    """
+    parts = link.split('|')
+    filename = parts[0]
+    description = parts[-1]
+    return {
+        "filename": filename,
+        "description": description,
+        "url": to_wikimedia_url(filename),
+        "thumb_url": to_wikimedia_thumb_url(filename, THUMB_WIDTH),
+    }
+
+
+def write_media_manifest(words, filename):
+    """
+    Write the media files (images and audio) referenced by the words. Each file is listed once, even when
+    referenced by several words, on a line type\tfilename\turl\tthumb_url\ttitles (titles separated by |).
+    The filenames are normalized as in the Wikimedia URLs (ex: "my file.jpg" and "My_file.jpg" are the same file).
+    :param words: the word's dictionaries
+    :param filename: the manifest file
+    :return: the number of media files
+    """
+    media = {}  # normalized filename => (type, titles)
+    for word in words:
+        references = [("image", image['filename']) for image in word.get('images', [])]
+        if 'audio' in word:
+            references.append(("audio", word['audio']))
+        for (type, media_filename) in references:
+            titles = media.setdefault(_hashname(media_filename), (type, []))[1]
+            if not titles or titles[-1] != word['title']:
+                titles.append(word['title'])
+
+    with codecs.open(filename, 'w', 'utf-8') as manifest:
+        for media_filename in sorted(media):
+            (type, titles) = media[media_filename]
+            thumb_url = to_wikimedia_thumb_url(media_filename, THUMB_WIDTH) if type == "image" else ""
+            manifest.write("%s\t%s\t%s\t%s\t%s\n" % (type, media_filename, to_wikimedia_url(media_filename), thumb_url,
+                                                    "|".join(titles)))
+    return len(media)
+
+
+# Many section are not relevant for us (ex: ===Number===).
+KEPT_SECTIONS = frozenset([
+    "===Pronunciation===",
+    "====Pronunciation====",
+    "===Noun===",
+    "====Noun====",
+    "===Verb===",
+    "====Verb====",
+    "===Pronoun===",
+    "====Pronoun====",
+    "===Preposition===",
+    "====Preposition====",
+    "===Prefix===",
+    "====Prefix====",
+    "===Particle===",
+    "====Particle====",
+    "===Interjection===",
+    "====Interjection====",
+    "===Determiner===",
+    "====Determiner====",
+    "===Conjunction===",
+    "====Conjunction====",
+    "===Adverb===",
+    "====Adverb====",
+    "===Adjective===",
+    # "====Adjective====" and "===Article===" have never been kept (a missing comma merged them).
+    # They are still ignored to keep the generated file unchanged.
+    "====Article====",
+    "====Synonyms====",
+    "=====Synonyms=====",
+    "====Translations====",
+    "=====Translations=====",
+])
+
+# Sections parsed with ABContentHandler._parseDefinitionBlock (the type of word is the name of the section)
+DEFINITION_SECTIONS = frozenset([
+    "Noun", "Verb", "Pronoun", "Preposition", "Prefix", "Particle", "Interjection",
+    "Determiner", "Conjunction", "Adverb", "Article", "Adjective",
+])
+
+# Methods of ABContentHandler parsing the other kept sections
+SECTION_PARSERS = {
+    "Pronunciation": "_parsePronunciationBlock",
+    "Translations": "_parseTranslationsBlock",
+    "Synonyms": "_parseSynonymsBlock",
+}
+
+# Blocks whose parsing results are cached (--cache), with the version of their parser.
+# Increment the version when changing the rules of a parser (or of the methods it calls) to invalidate its results.
+# Increment all of them when changing ABContentHandler._splitSections.
+BLOCK_VERSIONS = {
+    "definitions": 2,    # DEFINITION_SECTIONS
+    "pronunciation": 1,
+    "translations": 1,
+    "synonyms": 2,
+    "images": 1,         # ABContentHandler._parseImages
+}
+
+ETYMOLOGY_SECTION = re.compile(r'===Etymology (\d+)===')
+
+IMAGE_LINK = re.compile(r'\[\[Image:.*?\]\]')
+
+
+# Markup recognized when converting the wiki syntax (see ABContentHandler._xwiki2html)
+WIKI_TOKEN = re.compile(r'\{\{|\}\}|\[\[|\]\]|<!--')
+WIKI_TAG = re.compile(r'<\w*>.*?</\w*>')
+
+# Some labels are very common (almost all word have the "transitive" or "intransitive" label).
+# To avoid pollute the flashcard, we stripped these labels away.
+COMMON_LABELS = frozenset(["countable", "uncountable", "transitive", "intransitive"])
+# Some labels are not easy to display correctly (ex: {{en|familiar|_|or|_new}}
+# For simplicity, we ignore all labels in one of the following words is included among them
+FORBIDDEN_LABELS = frozenset(["with", "or", "the", "of", "_", "and", "outside"])
+# Try these substrings too
+FORBIDDEN_LABEL_SUBSTRINGS = ("'''", "AAVE", "by ", "in ")
+# Templates whose value is not enclosed with parenthesis (follow Wiktionary semantic)
+UNENCLOSED_TEMPLATES = frozenset(["l", "ux", "non-gloss definition"])
+
+
+def _link_value(link):
+    """
+    Return the displayed text of a link: [[mass]] or [[troy weight|troy ounce]]
+    :param link: the content between the brackets
+    """
+    # Only the pipes before the first ] are separators
+    bracket = link.find(']')
+    return link[link.rfind('|', 0, len(link) if bracket == -1 else bracket) + 1:]
+
+
+def _template_value(template):
+    """
+    Return the text replacing a template: {{label|en|sland}}, {{ux|Value to preserve}}, {{...}}, ...
+    :param template: the content between the braces
+    """
+    if template.startswith('label|en|'):
+        labels = template.split('|')[2:]
+        for label in labels:
+            if label in FORBIDDEN_LABELS or any(substring in label for substring in FORBIDDEN_LABEL_SUBSTRINGS):
+                return ''
+        filtered_labels = [label for label in labels if label not in COMMON_LABELS]
+        if filtered_labels:  # Maybe all filtered labels are common?
+            return '(' + ', '.join(filtered_labels) + ')'
+        return ''
+
+    if '|' not in template:  # Ex: {{...}}, {{,}}
+        return template
+    name = template[:template.find('|')]
+    value = template[template.rfind('|') + 1:]
+    if name in UNENCLOSED_TEMPLATES:
+        return value
+    return '(' + value + ')'
+
+
+def xwiki2html_regex(text):
+    """
+    Previous implementation of ABContentHandler._xwiki2html based on successive regex substitutions.
+    Kept as a reference for the benchmark (--benchmark).
+    """
+    text = re.sub(r'<\w*?>.*?</\w*?>', r'', text)            # <ref>url text</ref>
+    text = re.sub(r'\[\[([^]]*?\|)+(.*?)\]\]', r'\2', text)  # [[troy weight|troy ounce]]
+    text = re.sub(r'\[\[(.*?)\]\]', r'\1', text)             # [[mass]]
+    text = re.sub(r'<!--(.*?)-->', r'', text)
+
+    # Labels, act I: {{label|en|sland}}
+    for matching_label in re.findall("\{\{label[|]en[|].*?\}\}", text):
+        index_open = matching_label.find("{{")
+        index_close = matching_label.find("}}", index_open)
+        labels = matching_label[index_open + 2:index_close].split('|')[2:]
+
+        filtered_labels = []
+        filtered = False
+
+        for label in labels:
+            if label in FORBIDDEN_LABELS:
+                filtered = True
+
+            for substring in FORBIDDEN_LABEL_SUBSTRINGS:
+                if substring in label:
+                    filtered = True
+
+        if not filtered:
+            filtered_labels = [item for item in labels if item not in COMMON_LABELS]
+
+        if filtered_labels: # Maybe all filtered labels are common?
+            text = text.replace(matching_label, '(' + ', '.join(filtered_labels) + ')')
+        else:
+            text = text.replace(matching_label, '')
+
+    # Labels act II: the remaining labels {{...}}, {{ux|Value to preserve}}, ...
+    for matching_label in re.findall("\{\{.*?\}\}", text):
+        if '|' not in matching_label: # Ex: {{...}}, {{,}}
+            text = text.replace(matching_label, matching_label[2:-2])
+            continue
+        lindex = matching_label.find('|')
+        rindex = matching_label.rfind('|')
+        name = matching_label[2:lindex]
+        value = matching_label[rindex + 1:-2]
+        if name in UNENCLOSED_TEMPLATES:
+            # No need to enclose the label value (follow Wiktionary semantic)
+            pass
+        else: # Surrounds with parenthesis (follow Wiktionary semantic)
+            value = '(' + value + ')'
+        text = text.replace(matching_label, value)
+
+    return text.strip()
+
+
 """
 SAX Handler used to extract information from the large input XML file.
 Most of the processing happen in the method endElement() after each new word.
 """
 class ABContentHandler(xml.sax.ContentHandler):
 
-    def __init__(self):
+    def __init__(self, cache=None):
+        """
+        :param cache: the ParseCache to reuse the results of a previous run (optional)
+        """
         xml.sax.ContentHandler.__init__(self)
 
+        self.cache = cache
+
         # Flag to determine our current position inside the XML file
         self.in_page = False
         self.in_id = False
@@ -146,18 +414,29 @@ class ABContentHandler(xml.sax.ContentHandler):
         # We parse the new word and store the result inside the global variable
         global words
 
-        print("%s: %s" % (self.id, self.title))
+        # Add the new word
+        words.append(self._parseEntry(self.id, self.title, self.text))
+
+    def _parseEntry(self, id, title, text):
+        """
+        Parse a single entry of the dictionary.
+        :return: the word's dictionary
+        """
+        print("%s: %s" % (id, title))
 
         # Parse the wiki
-        properties = self._parseWiki(self.text)
+        if self.cache is None:
+            properties = self._parseWiki(text)
+            images = self._parseImages(text)
+        else:
+            (properties, images) = self._parseCachedWiki(text)
 
         # Add common properties
-        properties['id'] = self.id
-        properties['rank'] = ranking[self.title]
-        properties['title'] = self.title
+        properties['id'] = id
+        properties['rank'] = ranking[title]
+        properties['title'] = title
 
         # Post-processing
-        images = self._parseImages(self.text)
         if images:
             properties['images'] = images
         if 'translations' in properties:
@@ -166,8 +445,7 @@ class ABContentHandler(xml.sax.ContentHandler):
             audio_url = to_wikimedia_url(properties['audio'])
             properties['audio_url'] = audio_url
 
-        # Add the new word
-        words.append(properties)
+        return properties
 
     def _parseWiki(self, text):
         """
@@ -175,75 +453,97 @@ class ABContentHandler(xml.sax.ContentHandler):
         :param text: the character text inside the tag
         :return a dictionary containing all the extract information about the word
         """
-        buf = io.StringIO(text) # to read line by line
+        return self._parseSections(self._splitSections(text))
+
+    def _parseSections(self, sections, block=None):
+        """
+        Parse the sections extracted by _splitSections.
+        :param sections: the list of sections
+        :param block: parse only the sections of this block (see BLOCK_VERSIONS), all sections by default
+        :return a dictionary containing all the extract information about the word
+        """
+        # All relevant section text is now extracted. We will parse them individually and store the information
+        # inside this variable
+        result = {"types": []}
+
+        for section in sections:
+            type = section['type']
+            if type in DEFINITION_SECTIONS:
+                if block is None or block == "definitions":
+                    self._parseDefinitionBlock(section, result, type)
+            elif block is None or block == type.lower():
+                getattr(self, SECTION_PARSERS[type])(section, result)
+
+        return result
+
+    def _parseCachedWiki(self, text):
+        """
+        Same as _parseWiki and _parseImages, but reuse the results cached for the same text.
+        Each block is parsed on its own (the blocks complete different keys), so that a new version of
+        a parser only invalidates the results of its block.
+        :param text: the character text inside the tag
+        :return a tuple (dictionary containing all the extract information about the word, list of images)
+        """
+        digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        properties = {"types": []}
+        images = []
+        sections = None
 
+        keys = dict((block, ParseCache.key(digest, block)) for block in BLOCK_VERSIONS)
+        cached = self.cache.get(list(keys.values()))
+
+        for (block, key) in keys.items():
+            value = cached.get(key)
+            if value is None:
+                if block == "images":
+                    value = self._parseImages(text)
+                else:
+                    if sections is None:
+                        sections = self._splitSections(text)
+                    value = self._parseSections(sections, block)
+                    if block != "definitions":
+                        del value['types']
+                self.cache.put(key, value)
+
+            if block == "images":
+                images = value
+            else:
+                properties.update(value)
+
+        return (properties, images)
+
+    @staticmethod
+    def _splitSections(text):
+        """
+        Extract the relevant sections of the English part of the page.
+        :param text: the character text inside the tag
+        :return: the list of sections {"type": "Noun", "text": "..."} in the order of the page
+        """
         section_paths = [] # Answer the question: Where are we inside the doc?
         sections = []      # All identified relevant sections will be added inside this list
 
-        # Many section are not relevant for us (ex: ===Number===).
-        keep_text_for_section = [
-            "===Pronunciation===",
-            "===Noun===",
-            "====Noun====",
-            "===Verb===",
-            "====Verb====",
-            "===Pronunciation===",
-            "====Pronunciation====",
-            "===Pronoun===",
-            "====Pronoun====",
-            "===Preposition===",
-            "====Preposition====",
-            "===Prefix===",
-            "====Prefix====",
-            "===Particle===",
-            "====Particle====",
-            "===Noun===",
-            "====Noun====",
-            "===Interjection===",
-            "====Interjection====",
-            "===Determiner===",
-            "====Determiner====",
-            "===Conjunction===",
-            "====Conjunction====",
-            "===Adverb===",
-            "====Adverb====",
-            "===Adjective===",
-            "====Adjective===="
-            "===Article===",
-            "====Article====",
-            "====Synonyms====",
-            "=====Synonyms=====",
-            "====Translations====",
-            "=====Translations=====",
-        ]
-
-        # Buffer containing the text of the current section
-        current_section_text = ""
-        # Name of the current section that will be the previous section as soon as a new one is found
-        last_section = None
+        # Lines of the current section
+        current_section_lines = []
         # Should we ignore the text of the current section
         skip = False
+        # Should we save the text of the current section?
+        keep = False
 
-        while True:
-            line = buf.readline()
-            if not line: # EOF
-                break
+        for line in text.split('\n'):
             line = line.strip()
 
             if line.startswith("=="):  # New section found
                 current_section = line
 
-                last_section = None
-                if section_paths:
-                    last_section = section_paths[-1]
-
                 # Previous section should be kept?
-                if not skip and last_section in keep_text_for_section:
-                    sections.append({"type": last_section.strip(' ='), "text": current_section_text})
-                    current_section_text = ""
+                if keep:
+                    current_section_lines.append("")  # Each line ends with \n
+                    sections.append({"type": section_paths[-1].strip(' ='), "text": "\n".join(current_section_lines)})
+                current_section_lines = []
 
                 # Is the section more high-level than the previous one?
-                while section_paths and section_paths[-1].count('=') >= current_section.count('='):
+                level = current_section.count('=')
+                while section_paths and section_paths[-1].count('=') >= level:
                     section_paths.pop()  # Go up one level
 
                 if not line.startswith("===="):  # Reset skip flag when encounter a new top level (ex: ===Verb===)
@@ -259,69 +559,18 @@ class ABContentHandler(xml.sax.ContentHandler):
 
                 # Stop when we encounter a new etymology
                 # (the first one is often the only one pertinent when learning a new language)
-                m = re.search('===Etymology (\d+)===', current_section)
+                m = ETYMOLOGY_SECTION.search(current_section)
                 if m:
                     number = int(m.group(1))
                     if number > 1:
                         skip = True
 
-            elif not skip:  # Inside a section => collect the text
-                # Should we save the text of the current section?
-                if section_paths and section_paths[-1] in keep_text_for_section:
-                    current_section_text += line + "\n"
+                keep = not skip and current_section in KEPT_SECTIONS
 
-        # All relevant section text is now extracted. We will parse them individually and store the information
-        # inside this variable
-        result = {"types": []}
-
-        for section in sections:
-
-            if section['type'] == "Pronunciation":
-                self._parsePronunciationBlock(section, result)
-
-            if section['type'] == "Noun":
-                self._parseDefinitionBlock(section, result, 'Noun')
-
-            if section['type'] == "Verb":
-                self._parseDefinitionBlock(section, result, 'Verb')
-
-            if section['type'] == "Pronoun":
-                self._parseDefinitionBlock(section, result, 'Pronoun')
-
-            if section['type'] == "Preposition":
-                self._parseDefinitionBlock(section, result, 'Preposition')
-
-            if section['type'] == "Prefix":
-                self._parseDefinitionBlock(section, result, 'Prefix')
-
-            if section['type'] == "Particle":
-                self._parseDefinitionBlock(section, result, 'Particle')
-
-            if section['type'] == "Interjection":
-                self._parseDefinitionBlock(section, result, 'Interjection')
-
-            if section['type'] == "Determiner":
-                self._parseDefinitionBlock(section, result, 'Determiner')
+            elif keep:  # Inside a section => collect the text
+                current_section_lines.append(line)
 
-            if section['type'] == "Conjunction":
-                self._parseDefinitionBlock(section, result, 'Conjunction')
-
-            if section['type'] == "Adverb":
-                self._parseDefinitionBlock(section, result, 'Adverb')
-
-            if section['type'] == "Article":
-                self._parseDefinitionBlock(section, result, 'Article')
-
-            if section['type'] == "Adjective":
-                self._parseDefinitionBlock(section, result, 'Adjective')
-
-            if section['type'] == "Translations":
-                self._parseTranslationsBlock(section, result)
-
-            if section['type'] == "Synonyms":
-                self._parseSynonymsBlock(section, result)
-
-        return result
+        return sections
 
     @staticmethod
     def _xwiki2html(text):
@@ -332,65 +581,67 @@ class ABContentHandler(xml.sax.ContentHandler):
         - Remove label {{unsupported|#}}
         - Remove comment <!--isn't this \"pound sign\" rather than \"pound\"?-->
 
-        :param text: the raw text (a definition line, a quote, etc)
-        :return: the cleaned text.
-        """
-        text = re.sub(r'<\w*?>.*?</\w*?>', r'', text)            # <ref>url text</ref>
-        text = re.sub(r'\[\[([^]]*?\|)+(.*?)\]\]', r'\2', text)  # [[troy weight|troy ounce]]
-        text = re.sub(r'\[\[(.*?)\]\]', r'\1', text)             # [[mass]]
-        text = re.sub(r'<!--(.*?)-->', r'', text)
-
-        # Some labels are very common (almost all word have the "transitive" or "intransitive" label).
-        # To avoid pollute the flashcard, we stripped these labels away.
-        common_labels = ["countable", "uncountable", "transitive", "intransitive"]
-        # Some labels are not easy to display correctly (ex: {{en|familiar|_|or|_new}}
-        # For simplicity, we ignore all labels in one of the following words is included among them
-        forbidden_strings = ["with", "or", "the", "of", "_", "and", "outside"]
-        # Try these substrings too
-        forbidden_substrings = ["'''", "AAVE", "by ", "in "]
-
-        # Labels, act I: {{label|en|sland}}
-        for matching_label in re.findall("\{\{label[|]en[|].*?\}\}", text):
-            index_open = matching_label.find("{{")
-            index_close = matching_label.find("}}", index_open)
-            labels = matching_label[index_open + 2:index_close].split('|')[2:]
-
-            filtered_labels = []
-            filtered = False
-
-            for label in labels:
-                if label in forbidden_strings:
-                    filtered = True
+        The tags (<ref>url text</ref>) are removed first, then the text is scanned only once.
+        The templates and the links are replaced when their closing braces are found, so the nested markup
+        is always converted from the innermost (xwiki2html_regex converted all the links before the templates,
+        leaving some braces or brackets when they were nested):
 
-                for substring in forbidden_substrings:
-                    if substring in label:
-                        filtered = True
+        >>> ABContentHandler._xwiki2html("{{gloss|x {{label|en|informal}}}} y")
+        '(x (informal)) y'
+        >>> ABContentHandler._xwiki2html("[[a|[[b|c]]]] and {{l|en|{{l|en|x|y}}}}")
+        'c and y'
+        >>> ABContentHandler._xwiki2html("[[a|<ref>[[b]]</ref>]] and [[{{l|en|x|y}}]]")
+        'and y'
 
-            if not filtered:
-                filtered_labels = [item for item in labels if item not in common_labels]
+        The markup not closed is kept as is:
 
-            if filtered_labels: # Maybe all filtered labels are common?
-                text = text.replace(matching_label, '(' + ', '.join(filtered_labels) + ')')
-            else:
-                text = text.replace(matching_label, '')
+        >>> ABContentHandler._xwiki2html("{{gloss|[[a}} b]] c")
+        '([[a) b]] c'
 
-        # Labels act II: the remaining labels {{...}}, {{ux|Value to preserve}}, ...
-        for matching_label in re.findall("\{\{.*?\}\}", text):
-            if '|' not in matching_label: # Ex: {{...}}, {{,}}
-                text = text.replace(matching_label, matching_label[2:-2])
-                continue
-            lindex = matching_label.find('|')
-            rindex = matching_label.rfind('|')
-            name = matching_label[2:lindex]
-            value = matching_label[rindex + 1:-2]
-            if name in ["l", "ux", "non-gloss definition"]:
-                # No need to enclose the label value (follow Wiktionary semantic)
-                pass
-            else: # Surrounds with parenthesis (follow Wiktionary semantic)
-                value = '(' + value + ')'
-            text = text.replace(matching_label, value)
-
-        return text.strip()
+        :param text: the raw text (a definition line, a quote, etc)
+        :return: the cleaned text.
+        """
+        if '</' in text:
+            text = WIKI_TAG.sub('', text)
+        output = []
+        opened = []  # (token, position in output) of the templates and links not closed yet, the innermost last
+        position = 0
+        while True:
+            match = WIKI_TOKEN.search(text, position)
+            if not match:
+                output.append(text[position:])
+                break
+            output.append(text[position:match.start()])
+            token = match.group()
+            position = match.end()
+
+            if token == '{{' or token == '[[':
+                opened.append((token, len(output)))
+                output.append(token)
+
+            elif token == '<!--':
+                end = text.find('-->', position)
+                if end == -1:
+                    output.append(token)
+                else:
+                    position = end + 3
+
+            else:  # }} or ]]
+                opening = '{{' if token == '}}' else '[['
+                index = len(opened) - 1
+                while index >= 0 and opened[index][0] != opening:
+                    index -= 1
+                if index < 0:
+                    output.append(token)
+                    continue
+                # The markup opened inside and not closed stays as is
+                start = opened[index][1]
+                del opened[index:]
+                content = ''.join(output[start + 1:])
+                del output[start:]
+                output.append(_template_value(content) if token == '}}' else _link_value(content))
+
+        return ''.join(output).strip()
 
     @staticmethod
     def _highlight_term(text):
@@ -577,49 +828,427 @@ class ABContentHandler(xml.sax.ContentHandler):
         :param text: the full x-wiki text
         :return: the list of images
         """
-        images = []
+        if "Image:" not in text:  # Most words
+            return []
 
-        # Pictures could be present inline through a label
-        # Ex: [[Image:Pieni2.jpg|thumb|A hard-cover book]]
-        for match in re.findall('\[\[Image:.*?\]\]', text):
-            parts = match[len("[[Image:"):-2].split('|')
-            filename = parts[0]
-            description = parts[-1]
-            images.append({
-                "filename": filename,
-                "description": description,
-                "url": to_wikimedia_url(filename),
-                "thumb_url": to_wikimedia_thumb_url(filename, 600),
-            })
-
-        # Pictures could be present on dedicated line inside a <gallery>  tag
+        inline_images = []
+        gallery_images = []
         for line in text.split('\n'):
+            # Pictures could be present inline through a label
+            # Ex: [[Image:Pieni2.jpg|thumb|A hard-cover book]]
+            if "[[Image:" in line:
+                for match in IMAGE_LINK.findall(line):
+                    inline_images.append(_image_properties(match[len("[[Image:"):-2]))
+
+            # Pictures could be present on dedicated line inside a <gallery>  tag
             line = line.strip()
             if line.startswith("Image:"):
+                gallery_images.append(_image_properties(line[len("Image:"):]))
+
+        return inline_images + gallery_images
+
+class EntryContentHandler(ABContentHandler):
+    """
+    Handler collecting the raw entries (id, title, text) without parsing them.
+    """
+
+    def __init__(self):
+        ABContentHandler.__init__(self)
+        self.entries = []
+
+    def _parseWord(self):
+        self.entries.append((self.id, self.title, self.text))
+
+
+class ParseCache:
+    """
+    Results of the block parsers saved into a SQLite database to be reused by the next runs (--cache).
+    A result is identified by the hash of the entry text, the name of the block and the version of its parser.
+    The least recently used results are evicted when the total size of the results exceeds a limit.
+    """
+
+    def __init__(self, filename, readonly=False):
+        """
+        :param filename: the SQLite database (created if missing)
+        :param readonly: True in the worker processes (the new results are saved by the main process, see collect())
+        """
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, timeout=60)
+        self.readonly = readonly
+        if not readonly:
+            # The worker processes could read while the main process writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS block ("
+                                    "key TEXT PRIMARY KEY, value TEXT, size INTEGER, run INTEGER)")
+            # Runs are numbered to know when a result was last used
+            self.run = self.connection.execute("SELECT COALESCE(MAX(run), 0) + 1 FROM block").fetchone()[0]
+        self.used = []   # Keys of the results read
+        self.added = []  # (key, value) of the new results
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(digest, block):
+        return "%s:%s:%d" % (digest, block, BLOCK_VERSIONS[block])
+
+    def get(self, keys):
+        """
+        :param keys: the keys of the results of an entry (see key())
+        :return: the dictionary key => cached result (only for the keys found)
+        """
+        rows = self.connection.execute("SELECT key, value FROM block WHERE key IN (%s)" % ", ".join("?" * len(keys)),
+                                       keys).fetchall()
+        self.used.extend(key for (key, value) in rows)
+        self._autosave()
+        return dict((key, json.loads(value)) for (key, value) in rows)
+
+    def put(self, key, value):
+        self.added.append((key, json.dumps(value)))
+        self._autosave()
+
+    def _autosave(self):
+        if not self.readonly and len(self.used) + len(self.added) >= CACHE_BATCH_SIZE:
+            self.save(self.collect())
+
+    def collect(self):
+        """
+        Return the pending changes (to be saved by the main process).
+        """
+        changes = (self.used, self.added)
+        self.used = []
+        self.added = []
+        return changes
+
+    def save(self, changes):
+        """
+        Save the changes collected by this cache or by the cache of a worker process.
+        """
+        (used, added) = changes
+        self.hits += len(used)
+        self.misses += len(added)
+        with self.connection:
+            self.connection.executemany("UPDATE block SET run = ? WHERE key = ?", [(self.run, key) for key in used])
+            self.connection.executemany("INSERT OR REPLACE INTO block (key, value, size, run) VALUES (?, ?, ?, ?)",
+                                        [(key, value, len(value), self.run) for (key, value) in added])
+
+    def close(self, max_size):
+        """
+        Save the pending changes and evict the least recently used results.
+        :param max_size: the maximum total size of the results (in characters)
+        """
+        self.save(self.collect())
+        size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM block").fetchone()[0]
+        evicted = 0
+        if size > max_size:
+            evicted_keys = []
+            for (key, result_size) in self.connection.execute("SELECT key, size FROM block ORDER BY run"):
+                if size <= max_size:
+                    break
+                evicted_keys.append((key,))
+                size -= result_size
+            with self.connection:
+                self.connection.executemany("DELETE FROM block WHERE key = ?", evicted_keys)
+            evicted = len(evicted_keys)
+        print("Cache: %s result(s) reused, %s result(s) parsed, %s result(s) evicted" % (self.hits, self.misses, evicted))
+        self.connection.close()
+
+
+def iter_entries(filename):
+    """
+    Read the raw entries of the dictionary (XML file or SQLite database).
+    :return: a generator of (id, title, text)
+    """
+    if filename.endswith('.db'):
+        connection = sqlite3.connect(filename)
+        for entry in connection.execute("SELECT id, title, text FROM entry ORDER BY position"):
+            yield entry
+        connection.close()
+    else:
+        handler = EntryContentHandler()
+        parser = xml.sax.make_parser()
+        parser.setContentHandler(handler)
+        with open(filename) as source:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                for entry in handler.entries:
+                    yield entry
+                handler.entries = []
+        parser.close()
+        for entry in handler.entries:
+            yield entry
+
+
+def _batch(entries, size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-                parts = line[len("Image:"):].split('|')
-                filename = parts[0]
-                description = parts[-1]
-                images.append({
-                    "filename": filename,
-                    "description": description,
-                    "url": to_wikimedia_url(filename),
-                    "thumb_url": to_wikimedia_thumb_url(filename, 600),
-                })
 
-        return images
+# Cache used by a worker process (see _init_worker)
+worker_cache = None
+
+
+def _init_worker(cache_filename):
+    global worker_cache
+    if cache_filename:
+        worker_cache = ParseCache(cache_filename, readonly=True)
+
+
+def _parse_entries(entries):
+    """
+    Parse a batch of entries in a worker process.
+    :return: a tuple (list of word's dictionaries, changes of the cache or None)
+    """
+    handler = ABContentHandler(worker_cache)
+    batch_words = [handler._parseEntry(id, title, text) for (id, title, text) in entries]
+    return (batch_words, worker_cache.collect() if worker_cache else None)
+
+
+def parse_dictionary(filename, jobs=1, cache=None):
+    """
+    Parse all the entries of the dictionary generated by 4-parse_wiktionary.py (XML file or SQLite database).
+    :param jobs: the number of processes to parse the entries
+    :param cache: the ParseCache to reuse the results of a previous run (optional)
+    """
+    if jobs > 1:
+        cache_filename = cache.filename if cache else None
+        pool = multiprocessing.Pool(jobs, _init_worker, (cache_filename,))
+        try:
+            # Results are returned in order
+            for (batch_words, cache_changes) in pool.imap(_parse_entries, _batch(iter_entries(filename), BATCH_SIZE)):
+                words.extend(batch_words)
+                if cache_changes:
+                    cache.save(cache_changes)
+        finally:
+            pool.close()
+            pool.join()
+        return
+
+    handler = ABContentHandler(cache)
+    if filename.endswith('.db'):
+        # No XML parsing, entries are read in the order of the dump
+        connection = sqlite3.connect(filename)
+        for (id, title, text) in connection.execute("SELECT id, title, text FROM entry ORDER BY position"):
+            words.append(handler._parseEntry(id, title, text))
+        connection.close()
+    else:
+        xml.sax.parse(open(filename), handler)
+
+
+def read_removed_words(filename):
+    """
+    Read the list of words removed since the previous dump (one title per line).
+    """
+    removed = set()
+    for line in codecs.open(filename, 'r', 'utf-8'):
+        removed.add(line.rstrip('\n'))
+    return removed
+
+
+class WordWriter:
+    """
+    Write the words sorted by rank into a JSON Lines file (one word per line) using a bounded memory.
+    Words are sorted by runs saved into temporary files, and the runs are merged when closing the writer.
+    The writer replaces the global list words (append/extend) so that the words are written as soon as they are parsed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.words = []
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, word):
+        self.words.append((word['rank'], json.dumps(word, sort_keys=True, separators=(',', ':'))))
+        self.count += 1
+        if len(self.words) >= SORT_RUN_SIZE:
+            self.flush()
+
+    def extend(self, words):
+        for word in words:
+            self.append(word)
+
+    def flush(self):
+        """
+        Save the pending words into a new run (one line rank\tword per word).
+        """
+        if self.words:
+            self.words.sort(key=lambda word: word[0])  # Stable: words with the same rank keep their order
+            fd, run_filename = tempfile.mkstemp(prefix="words-", suffix=".run", dir=self.directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as run:
+                for (rank, word) in self.words:
+                    run.write("%d\t%s\n" % (rank, word))
+            self.runs.append(run_filename)
+            self.words = []
+
+    def close(self):
+        """
+        Merge the runs into the final file. Runs are removed afterwards.
+        """
+        self.flush()
+        runs = [open(run_filename, encoding="utf-8") for run_filename in self.runs]
+        try:
+            with codecs.open(self.filename, 'w', 'utf-8') as out:
+                for line in heapq.merge(*runs, key=_run_rank):
+                    out.write(line[line.index('\t') + 1:])
+        finally:
+            for run in runs:
+                run.close()
+            for run_filename in self.runs:
+                os.remove(run_filename)
+
+
+def _run_rank(line):
+    return int(line[:line.index('\t')])
+
+
+def iter_words(filename):
+    """
+    Read the words of a JSON Lines file generated with --format jsonl.
+    :return: a generator of word's dictionaries
+    """
+    with codecs.open(filename, 'r', 'utf-8') as words_file:
+        for line in words_file:
+            yield json.loads(line)
+
+
+def benchmark_xwiki2html(filename, repeat=5):
+    """
+    Compare the wiki converter with the previous implementation on the lines of the dictionary.
+    :param filename: the dictionary generated by 4-parse_wiktionary.py (.xml or .db)
+    :param repeat: the number of times each line is converted
+    """
+    lines = []
+    for (id, title, text) in iter_entries(filename):
+        for line in text.split('\n'):
+            line = line.strip()
+            if line.startswith('#') or line.startswith('*'):  # Definitions, quotes, synonyms, etc
+                lines.append(line.lstrip('#*: '))
+    print("%s line(s) read from %s" % (len(lines), filename))
+
+    for (name, convert) in [("regex", xwiki2html_regex), ("single-pass", ABContentHandler._xwiki2html)]:
+        start = time.perf_counter()
+        for i in range(repeat):
+            for line in lines:
+                convert(line)
+        elapsed = time.perf_counter() - start
+        print("%s: %.3fs, %.0f lines/sec" % (name, elapsed, len(lines) * repeat / elapsed))
+
+    different = sum(1 for line in lines if xwiki2html_regex(line) != ABContentHandler._xwiki2html(line))
+    print("%s line(s) converted differently" % different)
+
+
+def benchmark_sections(filename, repeat=3):
+    """
+    Measure the throughput of the parsing of the <text> tag (sections extraction, then parsing of each section).
+    :param filename: the dictionary generated by 4-parse_wiktionary.py (.xml or .db)
+    :param repeat: the number of times each entry is parsed
+    """
+    texts = [text for (id, title, text) in iter_entries(filename)]
+    print("%s entries read from %s" % (len(texts), filename))
+
+    handler = ABContentHandler()
+    for (name, parse) in [("sections", handler._splitSections), ("sections + blocks", handler._parseWiki)]:
+        start = time.perf_counter()
+        for i in range(repeat):
+            for text in texts:
+                parse(text)
+        elapsed = time.perf_counter() - start
+        print("%s: %.3fs, %.0f entries/sec" % (name, elapsed, len(texts) * repeat / elapsed))
+
 
 if __name__ == "__main__":
 
-    # Parse the input file
-    xml.sax.parse(
-            open("resources/mywiktionary.xml"),
-            ABContentHandler())
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input", help="Dictionary generated by 4-parse_wiktionary.py (.xml or .db)",
+                        default="resources/mywiktionary.xml")
+    parser.add_argument("--incremental", help="Parse only the modified entries and patch the previous JSON file",
+                        action='store_true')
+    parser.add_argument("-j", "--jobs", help="Number of processes to parse the entries (0 = one per core)",
+                        type=int, default=1)
+    parser.add_argument("--benchmark", help="Measure the throughput of a step of the parsing on the input file",
+                        choices=["xwiki2html", "sections"])
+    parser.add_argument("-c", "--cache", help="Reuse the parsing results of the previous runs saved into this "
+                                              "SQLite database (default: resources/mywiktionary.cache.db)",
+                        nargs='?', const="resources/mywiktionary.cache.db")
+    parser.add_argument("--cache-size", help="Maximum size of the cache in MB (the least recently used results "
+                                             "are evicted)",
+                        type=int, default=256)
+    parser.add_argument("-f", "--format", help="Format of the generated file: a JSON document or JSON Lines sorted "
+                                               "with a bounded memory (resources/mywiktionary.jsonl)",
+                        choices=["json", "jsonl"], default="json")
+    args = parser.parse_args()
+
+    if args.benchmark == "xwiki2html":
+        benchmark_xwiki2html(args.input)
+        exit(0)
+    if args.benchmark == "sections":
+        benchmark_sections(args.input)
+        exit(0)
+
+    (basename, extension) = os.path.splitext(args.input)
+    jobs = args.jobs or multiprocessing.cpu_count()
+    output_filename = 'resources/mywiktionary.' + args.format
+    cache = ParseCache(args.cache) if args.cache else None
+
+    if args.incremental:
+
+        # Parse only the new or modified entries
+        parse_dictionary(basename + ".changes" + extension, jobs, cache)
+
+        # Replace the previous versions of these words and remove the words no longer present
+        replaced = read_removed_words(basename + ".removed.txt")
+        replaced.update(word['title'] for word in words)
+        if args.format == "jsonl":
+            # The previous words are read while being written into temporary runs
+            modified_words = words
+            words = WordWriter(output_filename)
+            words.extend(modified_words)
+            words.extend(word for word in iter_words(output_filename) if word['title'] not in replaced)
+        else:
+            with codecs.open(output_filename, 'r', 'utf-8') as previous:
+                words.extend(word for word in json.load(previous) if word['title'] not in replaced)
+        print("%s word(s) updated or removed, %s word(s) in total" % (len(replaced), len(words)))
+
+    else:
+
+        if args.format == "jsonl":
+            # Write the words as soon as they are parsed
+            words = WordWriter(output_filename)
+
+        # Parse the input file
+        parse_dictionary(args.input, jobs, cache)
 
-    # Sort words by frequency rank
-    sorted_words = sorted(words, key=lambda k: k['rank'])
+    if cache:
+        cache.close(args.cache_size * 1024 * 1024)
 
-    # Dump result to a JSON file
     print("Dumping results...")
-    out = codecs.open('resources/mywiktionary.json', 'w', 'utf-8')
-    json.dump(sorted_words, out, sort_keys=True, indent=4, separators=(',',':'))
+    if args.format == "jsonl":
+        # Merge the runs sorted by frequency rank
+        words.close()
+        sorted_words = iter_words(output_filename)
+    else:
+        # Sort words by frequency rank
+        sorted_words = sorted(words, key=lambda k: k['rank'])
+
+        # Dump result to a JSON file
+        with codecs.open(output_filename, 'w', 'utf-8') as out:
+            json.dump(sorted_words, out, sort_keys=True, indent=4, separators=(',',':'))
+
+    # List the media files to download (each file once)
+    media_count = write_media_manifest(sorted_words, 'resources/mywiktionary.media.tsv')
+    print("%s media file(s) listed in resources/mywiktionary.media.tsv" % media_count)
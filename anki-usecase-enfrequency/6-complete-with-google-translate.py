@@ -8,13 +8,41 @@ To launch the program:
 
 $ python complete-with-google-translate.py
 
+Batches are sent concurrently but never faster than the allowed rate (token bucket). Ex: 1 call per minute:
+
+$ python complete-with-google-translate.py --rate 1 --period 60 --concurrency 2
+
+Any server following the LibreTranslate API (POST /translate) could replace Google Translate:
+
+$ python complete-with-google-translate.py --backend http --url http://localhost:5000/translate
+
+Translations are saved after each batch into a SQLite cache (<dictionary>.translations.db) and an append-only
+journal (<dictionary>.translations.journal): a translated word is never requested again. An interrupted run loses
+only the batches in progress (up to --concurrency batches), which are requested again by the next run. The completed
+dictionary (<dictionary>.new) is written at the end of the run. To only translate (several runs), then only write it:
+
+$ python complete-with-google-translate.py --no-dump
+$ python complete-with-google-translate.py --dump-only
+
+A local stand-in translator rejecting the calls exceeding the rate (HTTP 429) is available to test the settings:
+
+$ python complete-with-google-translate.py --stub-server 5000 --rate 10 --period 1
+$ python complete-with-google-translate.py --backend http --url http://localhost:5000/translate --rate 10 --period 1
+
 """
 
+import asyncio
 import json
 import codecs
-from googletrans import Translator
+import os
+import sqlite3
 import time
 import random
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 # How many words in a single API call?
 BATCH_SIZE = 200
@@ -22,59 +50,402 @@ BATCH_SIZE = 200
 # Limit the numbers of call per day to avoid being banned
 MAX_API_CALLS = 30
 
+# Allowed rate of the API calls: RATE calls every PERIOD seconds (a call every 2 minutes on average previously)
+RATE = 1
+PERIOD = 120
+
+# Number of API calls in progress at the same time
+CONCURRENCY = 2
+
+# Number of retries of a failed API call, the delay doubles after each failure (each retry is an API call)
+RETRIES = 5
+RETRY_DELAY = 10
+
 # Ignore words having rank lower than START_RANK
 START_RANK = 1
 
-# Directory local filepath 
+# Languages of the translations
+SOURCE_LANGUAGE = 'en'
+TARGET_LANGUAGE = 'fr'
+
+# Directory local filepath
 dictionary = '/home/julien/workshop/anki-scripting/anki-usecase-enfrequency/resources/mywiktionary.json'
 
-# Wrapper around the Google Translate API
-translator = Translator()
 
+class TokenBucket:
+    """
+    Rate limiter allowing `rate` calls every `period` seconds, with bursts of at most `capacity` calls.
+    """
+
+    def __init__(self, rate, period, capacity=1):
+        self.rate = rate / period  # Tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tolerance=0):
+        """
+        Take a token if one is available (never waits).
+        :param tolerance: the fraction of token missing still accepted
+        :return: True if the call is allowed
+        """
+        self._refill()
+        if self.tokens >= 1 - tolerance:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """
+        Wait until a call is allowed.
+        """
+        async with self.lock:  # First come, first served
+            while not self.consume():
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CallBudget:
+    """
+    Maximum number of API calls of a run, shared by all batches (retries included).
+    """
+
+    def __init__(self, max_calls):
+        self.remaining = max_calls
+        self.stopped = False
+
+    def take(self):
+        """
+        Count a call if the budget allows it.
+        :return: True if the call is allowed
+        """
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    def stop(self):
+        """
+        Refuse all the following calls (even the calls already counted and waiting for the rate limit).
+        """
+        self.remaining = 0
+        self.stopped = True
+
+
+def http_status(e):
+    """
+    Return the HTTP status code of a failed API call (None if the error is not an HTTP error).
+    """
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code
+    response = getattr(e, 'response', None)  # httpx/requests errors (googletrans)
+    return getattr(response, 'status_code', None)
+
+
+class GoogleBackend:
+    """
+    Google Translate through the unofficial googletrans library.
+    """
+
+    def __init__(self):
+        from googletrans import Translator
+        self.translator_class = Translator
+
+    async def translate(self, titles, src, dest):
+        # The library is synchronous (except the most recent versions): the call runs in a thread
+        loop = asyncio.get_event_loop()
+        translations = await loop.run_in_executor(
+            None, lambda: self.translator_class().translate(titles, src=src, dest=dest))
+        if asyncio.iscoroutine(translations):
+            translations = await translations
+        return [t.text for t in translations]
+
+
+class HttpBackend:
+    """
+    Translation server following the LibreTranslate API: POST {"q": [...], "source": "en", "target": "fr"}
+    returns {"translatedText": [...]}
+    """
+
+    def __init__(self, url, api_key=None):
+        self.url = url
+        self.api_key = api_key
+
+    async def translate(self, titles, src, dest):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._post, titles, src, dest)
+
+    def _post(self, titles, src, dest):
+        payload = {"q": titles, "source": src, "target": dest, "format": "text"}
+        if self.api_key:
+            payload["api_key"] = self.api_key
+        request = urllib.request.Request(self.url, data=json.dumps(payload).encode('utf-8'),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=120) as response:
+            return json.loads(response.read().decode('utf-8'))['translatedText']
+
+
+class TranslationCache:
+    """
+    Translations already received, saved into a SQLite database keyed by (src, dest, title).
+    Each completed batch is first appended to a journal (one JSON line per batch, written to disk at once).
+    The journal is replayed when opening the cache, so that a crash loses at most the batches in progress.
+    """
 
-with open(dictionary) as f:
-    words = json.load(f)
+    def __init__(self, filename, journal_filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS translation ("
+                                "src TEXT, dest TEXT, title TEXT, text TEXT, PRIMARY KEY (src, dest, title))")
+        self._replay(journal_filename)
+        self.journal = codecs.open(journal_filename, 'a', 'utf-8')
 
-    api_calls = 0
+    def _replay(self, journal_filename):
+        if not os.path.exists(journal_filename):
+            return
+        line = ''
+        with codecs.open(journal_filename, 'r', 'utf-8') as journal:
+            with self.connection:
+                for line in journal:
+                    try:
+                        batch = json.loads(line)
+                    except ValueError:  # Batch partially written during a crash
+                        continue
+                    self._insert(batch)
+            if line and not line.endswith('\n'):
+                # Do not append the next batch to the truncated line
+                with codecs.open(journal_filename, 'a', 'utf-8') as journal_end:
+                    journal_end.write('\n')
 
+    def _insert(self, batch):
+        self.connection.executemany("INSERT OR REPLACE INTO translation (src, dest, title, text) VALUES (?, ?, ?, ?)",
+                                    [(batch['src'], batch['dest'], title, text)
+                                     for (title, text) in batch['translations'].items()])
+
+    def add(self, src, dest, translations):
+        """
+        Save the translations of a batch.
+        :param translations: the dictionary title => translation
+        """
+        batch = {"src": src, "dest": dest, "translations": translations}
+        self.journal.write(json.dumps(batch, ensure_ascii=False) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        with self.connection:
+            self._insert(batch)
+
+    def translations(self, src, dest):
+        """
+        :return: the dictionary title => translation
+        """
+        return dict(self.connection.execute("SELECT title, text FROM translation WHERE src = ? AND dest = ?",
+                                            (src, dest)))
+
+    def close(self):
+        self.journal.close()
+        self.connection.close()
+
+
+def find_batches(words, translated, max_batches):
+    """
+    Group the words without translation by batches of BATCH_SIZE words (in the order of the dictionary).
+    :param translated: the titles already translated by a previous run
+    :param max_batches: the maximum number of batches
+    :return: the list of batches (list of word's dictionaries)
+    """
+    batches = []
+    current_words = []
+    for word in words:
+        has_translation = 'translations' in word and len(word['translations']) > 0
+        if has_translation or word['title'] in translated:
+            continue
+
+        if word['rank'] < START_RANK:
+            continue
+
+        current_words.append(word)
+
+        if len(current_words) == BATCH_SIZE:  # Batch processing to limit API calls
+            batches.append(current_words)
+            if len(batches) == max_batches:
+                break
+            current_words = []
+    return batches
+
+
+async def translate_batch(backend, cache, bucket, budget, semaphore, current_words, retries=RETRIES):
+    """
+    Translate a batch of words, retrying with an exponential backoff when the API call fails.
+    Every attempt consumes a call of the budget. The budget is exhausted when the API rejects a call
+    with HTTP 429 (Too Many Requests) or 403 (Forbidden): retrying would only make things worse.
+    The translations are saved into the cache.
+    :return: True if the batch was translated
+    """
+    titles = [w['title'] for w in current_words]
+    first_rank = current_words[0]['rank']
+    last_rank = current_words[-1]['rank']
+
+    async with semaphore:
+        for attempt in range(retries + 1):
+            # Count the call before waiting for the rate limit: no need to wait when no call is left
+            allowed = budget.take()
+            if allowed:
+                await bucket.acquire()
+                allowed = not budget.stopped
+            if not allowed:
+                print('\t... Skipped (ranks %s to %s): no API call left' % (first_rank, last_rank))
+                return False
+            print('Send words from rank %s to rank %s...\n[%s]' % (first_rank, last_rank, ','.join(titles)))
+            try:
+                translations = await backend.translate(titles, src=SOURCE_LANGUAGE, dest=TARGET_LANGUAGE)
+                break
+            except Exception as e:
+                if http_status(e) in (429, 403):
+                    print('\t... Rejected (ranks %s to %s): %s. Stopping all API calls' % (first_rank, last_rank, e))
+                    budget.stop()
+                    return False
+                if attempt == retries:
+                    print('\t... Failed (ranks %s to %s): %s' % (first_rank, last_rank, e))
+                    return False
+                delay = RETRY_DELAY * 2 ** attempt * random.uniform(1, 1.5)
+                print('\t... Failed (ranks %s to %s): %s. Retrying in %.0fs' % (first_rank, last_rank, e, delay))
+                await asyncio.sleep(delay)
+
+    print('\t... OK (ranks %s to %s)' % (first_rank, last_rank))
+    cache.add(SOURCE_LANGUAGE, TARGET_LANGUAGE, dict(zip(titles, translations)))
+    return True
+
+
+async def complete_translations(words, backend, cache, rate, period, concurrency, max_calls):
+    """
+    Translate the words without translation (and not already translated by a previous run).
+    Each batch is saved into the cache as soon as it is translated, so an interruption loses at most
+    `concurrency` batches (the ones in progress).
+    :param max_calls: the maximum number of API calls (retries included)
+    :return: the number of translated batches
+    """
+    batches = find_batches(words, cache.translations(SOURCE_LANGUAGE, TARGET_LANGUAGE), max_calls)
+    bucket = TokenBucket(rate, period)
+    budget = CallBudget(max_calls)
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[translate_batch(backend, cache, bucket, budget, semaphore, batch)
+                                     for batch in batches])
+    return sum(1 for translated in results if translated)
+
+
+def dump_dictionary(words, cache, output):
+    """
+    Write the dictionary completed with the translations of the cache.
+    :return: the number of completed words
+    """
+    translations = cache.translations(SOURCE_LANGUAGE, TARGET_LANGUAGE)
+    completed = 0
+    for word in words:
+        has_translation = 'translations' in word and len(word['translations']) > 0
+        if not has_translation and word['title'] in translations:
+            word['translations'] = [translations[word['title']]]
+            word['google_translate'] = True  # Machine translation (whatever the backend)
+            completed += 1
+
+    with codecs.open(output, 'w', 'utf-8') as out:
+        json.dump(words, out, sort_keys=True, indent=4, separators=(',',':'), ensure_ascii=False)
+    return completed
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_stub(port, rate, period):
+    """
+    Start a local stand-in translator following the LibreTranslate API.
+    The translation of a word is the word prefixed by the target language (ex: "fr:word").
+    The calls exceeding the rate are rejected with HTTP 429 (Too Many Requests).
+    """
+    bucket = TokenBucket(rate, period)
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    class StubHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            elapsed = time.monotonic() - start
+            with lock:
+                # Accept calls arriving a little early because of the network latency
+                allowed = bucket.consume(tolerance=0.05)
+            if not allowed:
+                print("%.3fs: rejected (too many requests)" % elapsed)
+                self.send_response(429)
+                self.end_headers()
+                return
+
+            print("%.3fs: %s word(s) translated" % (elapsed, len(payload['q'])))
+            body = json.dumps({"translatedText": ["%s:%s" % (payload['target'], q) for q in payload['q']]})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+
+        def log_message(self, format, *args):
+            pass
+
+    print("Stand-in translator listening on http://localhost:%s/translate" % port)
+    ThreadingHTTPServer(('', port), StubHandler).serve_forever()
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--dictionary", help="JSON file generated by 5-parse_mytionary.py",
+                        default=dictionary)
+    parser.add_argument("-b", "--backend", help="Translation service", choices=["google", "http"], default="google")
+    parser.add_argument("--url", help="URL of the translation server (--backend http)",
+                        default="http://localhost:5000/translate")
+    parser.add_argument("--api-key", help="API key of the translation server (--backend http)")
+    parser.add_argument("--rate", help="Number of API calls allowed every period", type=float, default=RATE)
+    parser.add_argument("--period", help="Period of the rate limit in seconds", type=float, default=PERIOD)
+    parser.add_argument("--concurrency", help="Number of API calls in progress at the same time",
+                        type=int, default=CONCURRENCY)
+    parser.add_argument("--max-calls", help="Number of API calls (retries included) sent before exiting",
+                        type=int, default=MAX_API_CALLS)
+    parser.add_argument("--no-dump", help="Only save the translations into the cache", action='store_true')
+    parser.add_argument("--dump-only", help="Only write the dictionary completed with the cached translations",
+                        action='store_true')
+    parser.add_argument("--stub-server", help="Start a stand-in translator on this port (no translation)",
+                        type=int, metavar="PORT")
+    args = parser.parse_args()
+
+    if args.stub_server:
+        serve_stub(args.stub_server, args.rate, args.period)
+        exit(0)
+
+    with open(args.dictionary) as f:
+        words = json.load(f)
+
+    # The translations are saved after each batch (to support resume)
+    cache = TranslationCache(args.dictionary + '.translations.db', args.dictionary + '.translations.journal')
     try:
-        current_words = []
-        for word in words:
-            has_translation = 'translations' in word and len(word['translations']) > 0
-            if has_translation:
-                continue
-
-            if word['rank'] < START_RANK:
-                continue
-
-            current_words.append(word)
-            
-            if len(current_words) == BATCH_SIZE:  # Batch processing to limit API calls
-                titles = [w['title'] for w in current_words]
-                first_rank = current_words[0]['rank']
-                last_rank = current_words[-1]['rank']
-                titles_str = ','.join(titles)
-                print('Send words from rank %s to rank %s...\n[%s]' % (first_rank, last_rank, titles_str))
-                translations = translator.translate(titles, src='en', dest='fr')
-                api_calls += 1
-                print('\t... OK')
-                for j, t in enumerate(translations):
-                    current_words[j]['translations'] = [t.text]
-                    current_words[j]['google_translate'] = True
-                
-                if api_calls >= MAX_API_CALLS:
-                    print("Reach max API calls. Exiting...")
-                    break
-                else:
-                    time.sleep(random.randint(90, 180))
-                current_words = []
-
-    except:
-        pass
-    
-    # We always write the output (to support resume)
-    output = dictionary + '.new'
-    print('Dumping results into %s ...' % output)
-    out = codecs.open(output, 'w', 'utf-8')
-    json.dump(words, out, sort_keys=True, indent=4, separators=(',',':'), ensure_ascii=False)
+        if not args.dump_only:
+            if args.backend == "google":
+                backend = GoogleBackend()
+            else:
+                backend = HttpBackend(args.url, args.api_key)
+
+            translated = asyncio.run(complete_translations(words, backend, cache, args.rate, args.period,
+                                                           args.concurrency, args.max_calls))
+            print("%s batch(es) translated" % translated)
 
+        if not args.no_dump:
+            output = args.dictionary + '.new'
+            print('Dumping results into %s ...' % output)
+            completed = dump_dictionary(words, cache, output)
+            print("%s word(s) completed" % completed)
+    finally:
+        cache.close()
@@ -1,24 +1,45 @@
 """
 Convert an Epub to Flashcards.
 
-By default, read from myepub/ inside the same folder.
-This folder is the unzipped version of the file myepub.epub.
+By default, read the file myepub.epub inside the same folder.
+The pages are read directly from the archive, in the order of the spine
+declared by the OPF file. An unzipped folder (ex: myepub/) is also supported.
+
+Usage:
+$ python epub2anki.py myepub.epub --load
+
+The pages are parsed by an event-driven parser keeping only the text blocs
+(--parser soup uses the previous BeautifulSoup implementation).
+Use --benchmark to compare both parsers on a generated book.
 """
 
 from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+from urllib.parse import unquote
 import codecs
+import io
+import multiprocessing
+import posixpath
 import sys
 import re
 import os
+import tempfile
+import time
+import tracemalloc
+import zipfile
 
 # Add Anki source to path
 sys.path.append("../anki")
 from anki.storage import Collection
+from anki.notes import Note
 
 
 # Constants
 PROFILE_HOME = os.path.expanduser("~/Documents/Anki/User 1")
+EPUB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "myepub.epub")
 EPUB_UNZIPPED_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "myepub")
+PARSERS = ['events', 'soup']
+READ_SIZE = 64 * 1024
 
 ##################
 # Global variables
@@ -71,89 +92,492 @@ class Idiom:
             print("  !! %s" % warning)
 
 
-def process_bloc(soup, bloc_element):
-    global chapter
-    global category
-    global idiom
-
-    for p in bloc_element.find_all('p'):
-
-        classes = p.get('class')
+class PackageParser(HTMLParser):
+    """
+    Collect the elements of META-INF/container.xml and of the OPF file.
+    Unlike an XML parser, HTMLParser also accepts the files that are not well-formed.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.rootfiles = []
+        self.items = {}  # id => href
+        self.itemrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'rootfile':
+            self.rootfiles.append(attrs['full-path'])
+        elif tag == 'item':
+            self.items[attrs['id']] = attrs['href']
+        elif tag == 'itemref':
+            self.itemrefs.append(attrs['idref'])
+
+
+class EpubBook:
+    """
+    Read the documents of an EPUB, from the .epub archive (the members are streamed, nothing is extracted)
+    or from an unzipped folder.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.archive = None if os.path.isdir(path) else zipfile.ZipFile(path)
+
+    def open(self, name):
+        """
+        Return a text stream on a document of the book.
+        :param name: the path of the document inside the book (ex: "OEBPS/Page_2.html")
+        """
+        if self.archive:
+            return io.TextIOWrapper(self.archive.open(name), encoding='utf-8')
+        return codecs.open(os.path.join(self.path, name), "r", "utf-8")
+
+    def spine(self):
+        """
+        Return the paths of the content documents in reading order.
+        The OPF file is found using META-INF/container.xml.
+        """
+        container = self._parse_package("META-INF/container.xml")
+        opf_path = container.rootfiles[0]
+        opf = self._parse_package(opf_path)
+
+        opf_directory = posixpath.dirname(opf_path)
+        return [posixpath.normpath(posixpath.join(opf_directory, unquote(opf.items[idref])))
+                for idref in opf.itemrefs]
+
+    def _parse_package(self, name):
+        parser = PackageParser()
+        with self.open(name) as f:
+            parser.feed(f.read())
+        parser.close()
+        return parser
+
+    def close(self):
+        if self.archive:
+            self.archive.close()
+
+
+def bloc_fragments(bloc_element):
+    """
+    Parse a bloc (BeautifulSoup element) without depending on the previous blocs.
+    """
+    return paragraph_fragments([(p.get('class'), p.get_text()) for p in bloc_element.find_all('p')])
+
+
+def paragraph_fragments(paragraphs):
+    """
+    Parse the paragraphs of a bloc without depending on the previous blocs.
+    :param paragraphs: the list of (classes, text) of the <p> of the bloc
+    :return: the list of fragments, in order. A fragment is a tuple whose first element is its kind:
+             ('category', heading text), ('idiom', en, fr), ('example', example), ('warning', text), ('message', text)
+    """
+    fragments = []
+
+    for (classes, text) in paragraphs:
 
         found = False
         for classe in classes:
             if u'Chapter-Heading_Toc' in classe or u'chaper-headibg-2-chiffres' in classe:
                 found = True
-                category = p.get_text()
-                index = category.index('. ')
-                if index:
-                    chapter = category[:index]
-                    category = category[index+2:]
-                print("Beginning category %s" % category)
+                fragments.append(('category', text))
 
         if found:
             continue
 
         if u'_1_IDIOM' in classes: # New idiom
-            #if idiom:
-            #    idiom.display()
-            #    print "\n\n"
-            idiom = Idiom(chapter, category)
-            idioms.append(idiom)
-            text = p.get_text()
 
             if '●' in text:
                 index = text.index('●')
-                idiom.set_en(text[:index])
-                idiom.set_fr(text[index+1:])
+                fragments.append(('idiom', text[:index], text[index+1:]))
             else:
-                idiom.set_en(p.get_text())
+                fragments.append(('idiom', text, ''))
         elif u'_2_EXEMPLE-IDIOM' in classes: # Example for previous idiom
-            text = p.get_text()
             if '. ' in text:
                 index = text.index('. ')
-                idiom.add_example({ 'en': text[:index + 1], 'fr': text[index +2:] })
+                fragments.append(('example', { 'en': text[:index + 1], 'fr': text[index +2:] }))
             elif '? ' in text:
                 index = text.index('? ')
-                idiom.add_example({ 'en': text[:index + 1], 'fr': text[index +2:] })
+                fragments.append(('example', { 'en': text[:index + 1], 'fr': text[index +2:] }))
             elif '! ' in text:
                 index = text.index('! ')
-                idiom.add_example({ 'en': text[:index + 1], 'fr': text[index +2:] })
+                fragments.append(('example', { 'en': text[:index + 1], 'fr': text[index +2:] }))
             elif '.”' in text:
                 index = text.index('.”')
-                idiom.add_example({ 'en': text[:index + 2], 'fr': text[index +2:] })
+                fragments.append(('example', { 'en': text[:index + 2], 'fr': text[index +2:] }))
             else:
-                print("[ERROR] Unable to find translation in example '%s'" % text)
+                fragments.append(('message', "[ERROR] Unable to find translation in example '%s'" % text))
         elif u'WARNING' in classes: # WARNING
-            idiom.add_warning(p.get_text())
+            fragments.append(('warning', text))
         else:
-            print("[ERROR] Unknown class %s" % (classes))
+            fragments.append(('message', "[ERROR] Unknown class %s" % (classes)))
 
+    return fragments
 
-def highlight_qualifier(text):
-    return re.sub(r'[(](.*?)[)]', r'<span class="qualifier">(\1)</span>', text)
+
+def merge_fragments(fragments):
+    """
+    Apply the fragments in order. The headings change the current chapter and category,
+    and the examples and the warnings are attached to the current idiom, even when they continue on a new page.
+    """
+    global chapter
+    global category
+    global idiom
+
+    for fragment in fragments:
+        kind = fragment[0]
+        if kind == 'category':
+            category = fragment[1]
+            index = category.index('. ')
+            if index:
+                chapter = category[:index]
+                category = category[index+2:]
+            print("Beginning category %s" % category)
+        elif kind == 'idiom':
+            #if idiom:
+            #    idiom.display()
+            #    print "\n\n"
+            idiom = Idiom(chapter, category)
+            idioms.append(idiom)
+            idiom.set_en(fragment[1])
+            idiom.set_fr(fragment[2])
+        elif kind == 'example':
+            idiom.add_example(fragment[1])
+        elif kind == 'warning':
+            idiom.add_warning(fragment[1])
+        else:
+            print(fragment[1])
 
 
-def read_idioms(page_start, page_end):
-    for i in range(page_start, page_end):
+def process_bloc(soup, bloc_element):
+    merge_fragments(bloc_fragments(bloc_element))
 
-        # Read the page content
-        epub_pagefile = os.path.join(EPUB_UNZIPPED_ROOT, "OEBPS/Page_%s.html" % i)
-        f = codecs.open(epub_pagefile, "r", "utf-8")
-        page_html = f.read()
-        f.close()
 
-        # Parse the HTML
-        soup = BeautifulSoup(page_html, 'html.parser')
+def highlight_qualifier(text):
+    return re.sub(r'[(](.*?)[)]', r'<span class="qualifier">(\1)</span>', text)
 
-        for bloc in soup.find_all('div', { 'class': 'Bloc-de-texte-standard'}):
 
-            if bloc.get('id') and bloc.get('id').startswith('_idContainer'):
-                print("(Page_%s) Found %s" % (i, bloc.get('id')))
-                process_bloc(soup, bloc)
+class BlocParser(HTMLParser):
+    """
+    Event-driven parser collecting the class and the text of the <p> of the standard text blocs.
+    Nothing else of the page is kept. The elements are opened and closed like BeautifulSoup does with html.parser,
+    so the result is the same as with find_all() and get_text().
+    """
+
+    # Elements without content (closed as soon as they are opened)
+    VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link',
+                               'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound',
+                               'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'])
+
+    # Whitespace-only strings are collapsed by BeautifulSoup (except in these elements)
+    ASCII_SPACES = dict.fromkeys(map(ord, '\x20\x0a\x09\x0c\x0d'))
+    PRESERVE_WHITESPACE_ELEMENTS = frozenset(['pre', 'textarea'])
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.blocs = []  # (id, paragraphs) in document order
+        self.stack = []  # open elements: (tag, bloc paragraphs, paragraph text)
+        self.open_blocs = []
+        self.open_texts = []
+        self.data = []  # text since the last tag (may be received in several parts)
+
+    def _end_data(self):
+        if not self.data:
+            return
+        data = ''.join(self.data)
+        self.data = []
+        if not self.open_texts:
+            return
+        if not data.translate(self.ASCII_SPACES) \
+                and not any(tag in self.PRESERVE_WHITESPACE_ELEMENTS for (tag, _, _) in self.stack):
+            data = '\n' if '\n' in data else ' '
+        for text in self.open_texts:
+            text.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self._end_data()
+        if tag in self.VOID_ELEMENTS:
+            return
+
+        paragraphs = None
+        text = None
+        if tag == 'div':
+            attrs = dict(attrs)
+            if 'Bloc-de-texte-standard' in (attrs.get('class') or '').split() \
+                    and attrs.get('id') and attrs.get('id').startswith('_idContainer'):
+                paragraphs = []
+                self.blocs.append((attrs['id'], paragraphs))
+                self.open_blocs.append(paragraphs)
+        elif tag == 'p' and self.open_blocs:
+            attrs = dict(attrs)
+            classes = attrs['class'].split() if attrs.get('class') is not None else None
+            text = []
+            for bloc_paragraphs in self.open_blocs:
+                bloc_paragraphs.append((classes, text))
+            self.open_texts.append(text)
+        self.stack.append((tag, paragraphs, text))
+
+    def handle_endtag(self, tag):
+        self._end_data()
+        if self.stack and self.stack[-1][0] == tag:
+            (_, paragraphs, text) = self.stack.pop()
+            if paragraphs is not None:
+                self.open_blocs.pop()
+            if text is not None:
+                self.open_texts.pop()
+            return
+
+        # Like BeautifulSoup, close the unclosed elements up to the last element with this name (if any)
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                closed = set(id(element) for (_, paragraphs, text) in self.stack[i:] for element in (paragraphs, text))
+                self.open_blocs = [paragraphs for paragraphs in self.open_blocs if id(paragraphs) not in closed]
+                self.open_texts = [text for text in self.open_texts if id(text) not in closed]
+                del self.stack[i:]
+                return
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_comment(self, data):
+        # Comments are not part of the text
+        self._end_data()
+
+    def handle_decl(self, decl):
+        self._end_data()
+
+    def handle_pi(self, data):
+        self._end_data()
+
+    def unknown_decl(self, data):
+        self._end_data()
+        if data.upper().startswith('CDATA['):
+            self.data.append(data[len('CDATA['):])
+            self._end_data()
+
+    def close(self):
+        HTMLParser.close(self)
+        self._end_data()
+
+    def paragraph_blocs(self):
+        """
+        Return the blocs as a list of (id, list of (classes, text)).
+        """
+        return [(bloc_id, [(classes, ''.join(text)) for (classes, text) in paragraphs])
+                for (bloc_id, paragraphs) in self.blocs]
+
+
+def page_fragments(book, page, parser='events'):
+    """
+    Parse a page of the book.
+    :param parser: 'events' to use a BlocParser, 'soup' to build the BeautifulSoup tree of the page
+    :return: the fragments of the page (see paragraph_fragments())
+    """
+    page_name = posixpath.splitext(posixpath.basename(page))[0]
+
+    fragments = []
+    if parser == 'soup':
+
+        # Parse the HTML (read from the stream)
+        with book.open(page) as f:
+            soup = BeautifulSoup(f, 'html.parser')
 
+        for bloc in soup.find_all('div', { 'class': 'Bloc-de-texte-standard'}):
 
-def bulk_loading_anki(idioms):
+            if bloc.get('id') and bloc.get('id').startswith('_idContainer'):
+                fragments.append(('message', "(%s) Found %s" % (page_name, bloc.get('id'))))
+                fragments.extend(bloc_fragments(bloc))
+
+    else:
+
+        # Feed the parser by chunks of the stream
+        bloc_parser = BlocParser()
+        with book.open(page) as f:
+            for chunk in iter(lambda: f.read(READ_SIZE), ''):
+                bloc_parser.feed(chunk)
+        bloc_parser.close()
+
+        for (bloc_id, paragraphs) in bloc_parser.paragraph_blocs():
+            fragments.append(('message', "(%s) Found %s" % (page_name, bloc_id)))
+            fragments.extend(paragraph_fragments(paragraphs))
+
+    return fragments
+
+
+# Book and parser used by each parsing process
+worker_book = None
+worker_parser = None
+
+
+def _init_worker(path, parser):
+    global worker_book
+    global worker_parser
+    worker_book = EpubBook(path)
+    worker_parser = parser
+
+
+def _worker_page_fragments(page):
+    return page_fragments(worker_book, page, worker_parser)
+
+
+def read_idioms(book, page_start=1, page_end=None, jobs=1, parser='events'):
+    """
+    Read the idioms of the pages.
+    The pages are parsed independently (in parallel when jobs > 1), then their fragments are merged in the order of the pages.
+    :param book: the EpubBook to read
+    :param page_start: the position of the first page in the spine (starting at 1)
+    :param page_end: the position of the page after the last page to read (default: until the end)
+    :param jobs: the number of processes parsing the pages
+    :param parser: the parser of the pages (see page_fragments())
+    """
+    pages = book.spine()
+    if page_end is None:
+        page_end = len(pages) + 1
+    pages = pages[page_start - 1:page_end - 1]
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, _init_worker, (book.path, parser))
+        try:
+            # imap() returns the fragments in the order of the pages
+            for fragments in pool.imap(_worker_page_fragments, pages):
+                merge_fragments(fragments)
+        finally:
+            pool.terminate()
+    else:
+        for page in pages:
+            merge_fragments(page_fragments(book, page, parser))
+
+
+def generate_book(filename, page_count):
+    """
+    Write a synthetic book with the same layout as the pages of myepub.epub (13 idioms per page).
+    """
+    style = "<style type=\"text/css\">\n" + "".join(
+        "span.CharOverride-%d {\n  color: #39499b;\n  font-size: %dpx;\n}\n" % (i, 100 + i) for i in range(1, 30)) + "</style>"
+    position = ' style="position: absolute; top: %.2fpx; left: 170.08px; letter-spacing: -1px;"'
+
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("mimetype", "application/epub+zip")
+        archive.writestr("META-INF/container.xml",
+                         '<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">\n'
+                         '<rootfiles>\n  <rootfile full-path="OEBPS/volume.opf" media-type="application/oebps-package+xml" />\n'
+                         '</rootfiles>\n</container>\n')
+        archive.writestr("OEBPS/volume.opf",
+                         '<?xml version="1.0" encoding="UTF-8"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0">\n'
+                         '<manifest>\n%s</manifest>\n<spine>\n%s</spine>\n</package>\n' % (
+                             "".join('  <item href="Page_%d.html" id="Page_%d" media-type="application/xhtml+xml"/>\n' % (i, i)
+                                     for i in range(1, page_count + 1)),
+                             "".join('  <itemref idref="Page_%d" linear="yes"/>\n' % i for i in range(1, page_count + 1))))
+
+        for i in range(1, page_count + 1):
+            paragraphs = []
+            if i % 20 == 1:
+                paragraphs.append('<p class="_1_Chapter-Heading_Toc_1 ParaOverride-1"><span class="CharOverride-2">\n'
+                                  '        %d. Chapitre %d\n      </span></p>' % (i // 20 + 1, i // 20 + 1))
+            for j in range(13):
+                top = 1250.55 + j * 300
+                paragraphs.append('<p class="_1_IDIOM ParaOverride-1"%s><span class="Examples1 CharOverride-4">'
+                                  'To take idiom %d-%d (familier) ● Expression %d-%d</span></p>' % (position % top, i, j, i, j))
+                paragraphs.append('<p class="_2_EXEMPLE-IDIOM ParaOverride-1"%s><span class="EXEMPLE-IDIO CharOverride-5">'
+                                  'He took idiom %d-%d. </span><span class="CharOverride-7">Il a pris l\'expression %d-%d.</span></p>'
+                                  % (position % (top + 100), i, j, i, j))
+                if j % 4 == 0:
+                    paragraphs.append('<p class="WARNING"%s><span class="CharOverride-10">Note: &laquo;idiom&raquo; %d-%d</span></p>'
+                                      % (position % (top + 200), i, j))
+            archive.writestr("OEBPS/Page_%d.html" % i,
+                             '<?xml version="1.0" encoding="UTF-8" standalone="no"?><html xmlns="http://www.w3.org/1999/xhtml">'
+                             '<head>\n<meta charset="utf-8"/>\n<title>Page %d</title>\n%s\n</head>\n<body>\n<article id="Layout">\n'
+                             '<div class="Bloc-de-texte-standard" id="_idContainer%03d">\n<div style="width: 5046px;">\n%s\n</div>\n</div>\n'
+                             '<div class="Bloc-de-texte-standard" id="Folio">\n<p class="Folio">%d</p>\n</div>\n'
+                             '<div id="_idContainer999"><img src="images/Page_%d.jpg"/></div>\n</article>\n</body>\n</html>\n'
+                             % (i, style, i, "\n".join(paragraphs), i, i))
+
+
+def benchmark(page_count=300):
+    """
+    Compare the parsers on a synthetic book: pages/sec, then peak memory (measured in a second run with tracemalloc).
+    """
+    directory = tempfile.mkdtemp(prefix="epub2anki-benchmark-")
+    filename = os.path.join(directory, "benchmark.epub")
+    try:
+        generate_book(filename, page_count)
+        book = EpubBook(filename)
+        pages = book.spine()
+
+        results = {}
+        for parser in PARSERS:
+            start = time.time()
+            results[parser] = [page_fragments(book, page, parser) for page in pages]
+            elapsed = time.time() - start
+
+            tracemalloc.start()
+            for page in pages:
+                page_fragments(book, page, parser)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print("%-6s: %d pages in %.2fs (%.0f pages/sec), peak memory %.1f MB" % (
+                parser, len(pages), elapsed, len(pages) / elapsed, peak / 1048576.0))
+
+        if results['events'] != results['soup']:
+            print("[ERROR] The parsers return different fragments")
+        book.close()
+    finally:
+        os.remove(filename)
+        os.rmdir(directory)
+
+
+def idiom_fields(idiom):
+    """
+    Return the fields of the note (English, French, Examples, Notes), or None if the idiom has no expression.
+    """
+
+    # Set the content
+    english_field = highlight_qualifier(idiom.en)
+    french_field = highlight_qualifier(idiom.fr)
+    examples_field = "" # fill below
+    note_field =  "" # fill below
+
+    if not idiom.en:
+        # Should not happen
+        return None
+    if not idiom.fr and idiom.examples:
+        # Sometimes, there is not translation in french, we used the first example phrase instead
+        english_field = idiom.examples[0]['en']
+        french_field = idiom.examples[0]['fr']
+    if "(familier)" in idiom.en:
+        french_field += " " + highlight_qualifier('(familier)')
+
+    for example in idiom.examples:
+        examples_field += '<p class="example"><span class="english">%s</span> <span class="french">%s</span></p>' \
+            % (example['en'], example['fr'])
+
+    for warning in idiom.warnings:
+        note_field += '<p class="warning">%s<p>' % warning
+
+    return [english_field, french_field, examples_field, note_field]
+
+
+def normalize_expression(text):
+    """
+    Return the key used to detect the idioms already loaded: the English field without HTML tags, case or extra whitespace.
+    """
+    return ' '.join(re.sub(r'<[^>]*>', '', text).split()).lower()
+
+
+def index_idioms(col, model):
+    """
+    Return the normalized English fields of the existing notes of the note type.
+    """
+    return set(normalize_expression(flds.split("\x1f")[0])
+               for (nid, flds) in col.db.all("select id, flds from notes where mid = ?", model['id']))
+
+
+def bulk_loading_anki(idioms, verbose=False):
+    """
+    Add the idioms to Anki in a single transaction. The idioms already present in the collection are skipped.
+    :param verbose: print the content of each note
+    """
 
     # Load the anki collection
     cpath = os.path.join(PROFILE_HOME, "collection.anki2")
@@ -165,59 +589,76 @@ def bulk_loading_anki(idioms):
 
     # Get the deck
     deck = col.decks.byName("English")
+    modelBasic['did'] = deck['id']
+
+    # Set the tags (added to the deck configuration once all notes are added)
+    tags = col.tags.canonify(col.tags.split("idiom"))
+
+    existing = index_idioms(col, modelBasic)
+    added = 0
+    skipped = 0
 
     # Iterate over idioms
     for idiom in idioms:
 
+        fields = idiom_fields(idiom)
+        if not fields:
+            continue
+
+        key = normalize_expression(fields[0])
+        if key in existing:
+            skipped += 1
+            if verbose:
+                print("Skipping %s (already present)" % fields[0])
+            continue
+
         # Instantiate the new note
-        note = col.newNote()
-        note.model()['did'] = deck['id']
+        note = Note(col, modelBasic)
+        note.fields[:4] = fields
 
-        # Set the content
-        english_field = highlight_qualifier(idiom.en)
-        french_field = highlight_qualifier(idiom.fr)
-        examples_field = "" # fill below
-        note_field =  "" # fill below
+        if verbose:
+            print("{\nEnglish: %s,\nFrench: %s,\nExamples: %s,\nNotes: %s}" % (
+                note.fields[0], note.fields[1], note.fields[2], note.fields[3]))
 
-        if not idiom.en:
-            # Should not happen
-            continue
-        if not idiom.fr and idiom.examples:
-            # Sometimes, there is not translation in french, we used the first example phrase instead
-            english_field = idiom.examples[0]['en']
-            french_field = idiom.examples[0]['fr']
-        if "(familier)" in idiom.en:
-            french_field += " " + highlight_qualifier('(familier)')
-
-        for example in idiom.examples:
-            examples_field += '<p class="example"><span class="english">%s</span> <span class="french">%s</span></p>' \
-                % (example['en'], example['fr'])
-
-        for warning in idiom.warnings:
-            note_field += '<p class="warning">%s<p>' % warning
-
-        note.fields[0] = english_field
-        note.fields[1] = french_field
-        note.fields[2] = examples_field
-        note.fields[3] = note_field
-
-        print("{\nEnglish: %s,\nFrench: %s,\nExamples: %s,\nNotes: %s}" % (
-            note.fields[0], note.fields[1], note.fields[2], note.fields[3]))
-
-        # Set the tags (and add the new ones to the deck configuration
-        tags = "idiom"
-        note.tags = col.tags.canonify(col.tags.split(tags))
-        m = note.model()
-        m['tags'] = note.tags
-        col.models.save(m)
+        note.tags = list(tags)
 
         # Add the note
         col.addNote(note)
+        added += 1
+
+    if added:
+        modelBasic['tags'] = tags
+        col.models.save(modelBasic)
 
     # Save the changes to DB
     col.save()
+    print("%d idioms added, %d skipped (already present)" % (added, skipped))
+
 
 if __name__ == '__main__':
 
-    read_idioms(2, 2) # Only the second page of our demo ebook contains idioms
-    #bulk_loading_anki(idioms)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("epub", nargs='?', help="EPUB file (or unzipped folder) to convert", default=EPUB_FILE)
+    parser.add_argument("--from", help="Position of the first page to read", type=int, default=1, dest="start")  # reserved word
+    parser.add_argument("--to", help="Position of the page after the last page to read", type=int, dest="end")
+    parser.add_argument("-j", "--jobs", help="Number of processes to parse the pages (0 = one per core)",
+                        type=int, default=1)
+    parser.add_argument("-p", "--parser", help="Parser of the pages", choices=PARSERS, default='events')
+    parser.add_argument("--benchmark", help="Compare the parsers on a synthetic book of 300 pages", action='store_true')
+    parser.add_argument("-v", "--verbose", help="Print the content of the loaded notes", action='store_true')
+    parser.add_argument("--load", help="Load the idioms into Anki", action='store_true')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark()
+        sys.exit(0)
+
+    book = EpubBook(args.epub)
+    read_idioms(book, args.start, args.end, args.jobs or multiprocessing.cpu_count(), args.parser)
+    book.close()
+    print("%d idioms found" % len(idioms))
+
+    if args.load:
+        bulk_loading_anki(idioms, args.verbose)
@@ -8,13 +8,15 @@ A search bar is also present at the top of this file to filter the cards.
 Technologies: AngularJS 1.x, CSS 3.0, HTML 5
 """
 
-import sys, os, codecs, re, shutil
+import sys, os, codecs, re, shutil, time
 sys.path.append("../anki")
 from anki.storage import Collection
+from anki.utils import ids2str
 
 # Constants
 PROFILE_HOME = os.path.expanduser("~/Documents/Anki/User 1")
 OUTPUT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "target")
+CHUNK_SIZE = 500 # Number of cards rendered at once
 
 
 def rawText(text):
@@ -52,6 +54,38 @@ def extractMedia(text):
     return text_with_prefix_folder
 
 
+def iterCards(col, query):
+    """
+    Iterate over the cards matching the query, by chunks of CHUNK_SIZE cards.
+    For each chunk, the card and note rows are fetched in a single query and the cards are rendered in a single call.
+    The models and the tags of the notes are cached (sibling cards share the same note).
+    :return: an iterator of (card id, card ord, model, tags, rendering)
+    """
+    models = {}
+    notes = {}
+    cids = col.findCards(query)
+    for i in range(0, len(cids), CHUNK_SIZE):
+        chunk = cids[i:i + CHUNK_SIZE]
+
+        rows = {}
+        for (cid, card_ord, nid, mid, tags) in col.db.all(
+                "select c.id, c.ord, n.id, n.mid, n.tags from cards c, notes n where c.nid = n.id and c.id in %s" % ids2str(chunk)):
+            rows[cid] = (card_ord, nid, mid, tags)
+
+        # We could use a convenient method exposed by Anki to evaluate the templates
+        renderings = {}
+        for rendering in col.renderQA(chunk, "card"):
+            renderings[rendering['id']] = rendering
+
+        for cid in chunk:
+            (card_ord, nid, mid, tags) = rows[cid]
+            if mid not in models:
+                models[mid] = col.models.get(mid)
+            if nid not in notes:
+                notes[nid] = col.tags.split(tags)
+            yield (cid, card_ord, models[mid], notes[nid], renderings[cid])
+
+
 if __name__ == '__main__':
 
     # Load the anki collection
@@ -59,25 +93,17 @@ if __name__ == '__main__':
     col = Collection(cpath, log=True)
 
     # Iterate over all cards
+    start = time.time()
     cards = {}
-    for cid in col.findCards("tag:Git"):
-        card = col.getCard(cid)
-
-        # Retrieve the node to determine the card type model
-        note = col.getNote(card.nid)
-        model = col.models.get(note.mid)
-        tags = note.tags
-
+    for (cid, card_ord, model, tags, rendering) in iterCards(col, "tag:Git"):
         # Card contains the index of the template to use
-        template = model['tmpls'][card.ord]
+        template = model['tmpls'][card_ord]
 
         # We retrieve the question and answer templates
         question_template = template['qfmt']
         answer_template = template['afmt']
 
-        # We could use a convenient method exposed by Anki to evaluate the templates
-        rendering = col.renderQA([cid], "card")[0] # Only one element when coming from a given card
-                                                   # Could be more when passing a note of type "Basic (with reversed card)"
+        # The rendering of the card is done by iterCards()
         question = rendering['q']
         answer = rendering['a']
 
@@ -231,3 +257,5 @@ angular.module('ankiApp', [])
     index_file = codecs.open(os.path.join(OUTPUT_DIRECTORY, index_filename), "w", "utf-8")
     index_file.write(html)
     index_file.close()
+
+    print("%d cards exported in %.1fs" % (len(cards), time.time() - start))
@@ -4,11 +4,12 @@
 Load a word JSON file saved by this application to Anki.
 """
 
-import os, json, shutil, sys, re
+import os, json, shutil, sys, re, tempfile, time, multiprocessing, multiprocessing.pool, hashlib, sqlite3
 
 # Add Anki source to path
 sys.path.append("../../anki")
 from anki.storage import Collection
+from anki.notes import Note
 import anki.sched
 
 class Word:
@@ -16,6 +17,10 @@ class Word:
     Wrapper around a single JSON file generated by the web application
     """
 
+    # Methods rendering the fields (see benchmark_fields())
+    RENDERERS = ["abbreviated_types", "definitions_with_samples", "definitions_only", "image", "ipa",
+                 "translation", "synonyms", "samples", "definition_cards"]
+
     TYPES_ABBR = {
       "Adjective": "adj.",
       "Adverb": "adv.",
@@ -33,6 +38,7 @@ class Word:
 
     def __init__(self, doc):
         self.doc = doc
+        self.title_regex = None
 
     def title(self):
         return self.doc['title']
@@ -60,49 +66,36 @@ class Word:
             return None
 
     def definitions_with_samples(self):
-        html = ""
+        html = []
         for type in self.doc["types"]:
             if "include" in type and type["include"]:
-                subhtml = ""
+                subhtml = []
                 if "definitions" in type:
                     for definition in type["definitions"]:
                         if "include" in definition and definition["include"]:
-                            subhtml += "<li>" + self._escape(definition["text"])
+                            quotations = None
                             if "quotations" in definition:
-                                first_quotation = True
-                                quotation_found = False
-                                for quotation in definition["quotations"]:
-                                    if "include" in quotation and quotation["include"]:
-                                        quotation_found = True
-                                        if first_quotation:
-                                            subhtml += "<ul>"
-                                            first_quotation = False
-                                        subhtml += "<li>" + self._escape(quotation["text"]) + "</li>"
-                                if quotation_found:
-                                    subhtml += "</ul>"
-                            subhtml += "</li>"
+                                quotations = [quotation["text"] for quotation in definition["quotations"]
+                                              if "include" in quotation and quotation["include"]]
+                            if quotations:
+                                # The separators contain no brace to escape
+                                subhtml.append(self._escape("<li>%s<ul><li>%s</li></ul></li>" % (definition["text"], "</li><li>".join(quotations))))
+                            else:
+                                subhtml.append("<li>%s</li>" % self._escape(definition["text"]))
                 # Add the definition if at least one definition was included
                 if subhtml:
-                    html += "<em>" + type["type"] + "</em>" + "<ul>" + subhtml + "</ul>"
+                    html.append("<em>%s</em><ul>%s</ul>" % (type["type"], "".join(subhtml)))
 
-        return html
+        return "".join(html)
 
     def definitions_only(self):
         for type in self.doc["types"]:
             if "definitions" in type and "card_definitions" in type and type["card_definitions"]:
-                selected_definitions = []
-                for definition in type["definitions"]:
-                    if "include" in definition and definition["include"]:
-                        selected_definitions.append(definition["text"])
+                selected_definitions = [self._escape(definition["text"]) for definition in type["definitions"]
+                                        if "include" in definition and definition["include"]]
                 if selected_definitions:
-                    html = "<em>" + type["type"] + "</em>"
-                    html += "<ul>"
-                    for definition in selected_definitions:
-                        html += "<li>" + self._escape(definition) + "</li>"
-                    html += "</ul>"
-
                     # Only one type is  supported
-                    return html
+                    return "<em>%s</em><ul><li>%s</li></ul>" % (type["type"], "</li><li>".join(selected_definitions))
 
         return None
 
@@ -150,9 +143,8 @@ class Word:
                     if "quotations" in definition:
                         for quotation in definition["quotations"]:
                             if "card_sample" in quotation and quotation["card_sample"]:
-                                regex = re.compile(re.escape(self.title()), re.IGNORECASE)
                                 answer = self._escape(quotation["text"])
-                                sample = regex.sub("[...]", answer)
+                                sample = self._hide_title(answer)
                                 if "card_sample_hint" in quotation and quotation["card_sample_hint"]:
                                     sample += "<br><br><small>Hint</small> " + definition["text"]
                                 result[sample] = answer
@@ -193,23 +185,56 @@ class Word:
     def has_translation_card(self):
         return "card_translate" in self.doc and self.doc["card_translate"]
 
+    def _hide_title(self, text):
+        """
+        Replace the word by "[...]" in a sample, ignoring the case.
+        """
+        title = self.title()
+        if title and title.isascii() and text.isascii():
+            # No need for a regex when lowercasing is enough to ignore the case
+            lower_text = text.lower()
+            lower_title = title.lower()
+            parts = []
+            start = 0
+            index = lower_text.find(lower_title)
+            while index >= 0:
+                parts.append(text[start:index])
+                parts.append("[...]")
+                start = index + len(title)
+                index = lower_text.find(lower_title, start)
+            parts.append(text[start:])
+            return "".join(parts)
+
+        # The regex is compiled once per word
+        if self.title_regex is None:
+            self.title_regex = re.compile(re.escape(title), re.IGNORECASE)
+        return self.title_regex.sub("[...]", text)
+
     def _escape(self, text):
         return text.replace('}', '').replace('{', '')
 
 
 
-def load(col, filepath, deck_name):
+# Number of files sent at once to a parsing process
+CHUNK_SIZE = 20
+
+# Number of media files copied at once, and number of threads copying them
+MEDIA_BATCH_SIZE = 100
+MEDIA_THREADS = 4
+
+# Ordered fields as defined in Anki note type
+ANKI_FIELDS = ["Word", "Sound", "DefinitionsWithSamples", "DefinitionsOnly", "Image", "IPA", "Translation", "Synonyms", "SampleA", "SampleB", "SampleC", "HasImageCard", "HasDefinitionsCard", "AnswerA", "AnswerB", "AnswerC", "HasTranslationCard", "DefinitionA", "DefinitionB", "Rank", "Types" ]
+
+
+def read_fields(filepath):
     """
-    Load a single word into Anki. Read the dictionary entry file and try to load the picture and the sound in the same folder if present.
-    :param col: the Anki collection reference
+    Read a word JSON file and compute the fields of the note. The picture and the sound are searched in the same folder.
     :param filepath: the file path of the JSON document file
-    :param deck_name: the name of the Deck to use
+    :return: a tuple (word, fields, media files to copy into the collection)
     """
 
     directory = os.path.dirname(filepath)
-    basename = os.path.basename(filepath)
-
-    media_directory = os.path.join(os.path.dirname(col.path), "collection.media")
+    media = []
 
     print("Opening file %s" % filepath)
     with open(filepath, 'r') as f:
@@ -229,11 +254,7 @@ def load(col, filepath, deck_name):
                 audio_name = filename + '.' + extension
                 audio_path = os.path.join(directory, audio_name)
                 if os.path.exists(audio_path):
-                    source_path = audio_path
-                    target_path = os.path.join(media_directory, audio_name)
-                    print("Copying media file %s to %s" % (source_path, target_path))
-                    col.media.addFile(source_path)
-                    #shutil.copyfile(source_path, target_path)
+                    media.append(audio_path)
                     fields["Sound"] = "[sound:%s]" % audio_name
 
         fields["DefinitionsWithSamples"] = word.definitions_with_samples()
@@ -244,11 +265,7 @@ def load(col, filepath, deck_name):
             image_name = "%s-%s-thumb.jpg" % (word.rank(), word.title())
             image_path = os.path.join(directory, image_name)
             if os.path.exists(image_path):
-                source_path = os.path.join(directory, image_name)
-                target_path = os.path.join(media_directory, image_name)
-                print("Copying media file %s to %s" % (source_path, target_path))
-                col.media.addFile(source_path)
-                #shutil.copyfile(source_path, target_path)
+                media.append(image_path)
                 fields["Image"] = '<img src="%s">' % image_name
 
         if word.ipa():
@@ -284,48 +301,454 @@ def load(col, filepath, deck_name):
 
         #print(json.dumps(fields, indent=4))
 
+    return (word, fields, media)
+
+
+def file_rank(filepath):
+    """
+    Extract the rank from a file name like "57-by.json".
+    """
+    filename = os.path.basename(filepath)
+    return int(filename[:filename.index('-')])
+
+
+def iter_fields(filepaths, jobs=1):
+    """
+    Read the word files in rank order (see read_fields()).
+    :param jobs: the number of processes reading the files and rendering the fields
+    """
+    filepaths = sorted(filepaths, key=file_rank)
+
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # imap() returns the results in the order of the files
+            for result in pool.imap(read_fields, filepaths, CHUNK_SIZE):
+                yield result
+        finally:
+            pool.terminate()
+    else:
+        for filepath in filepaths:
+            yield read_fields(filepath)
+
+
+def add_media(col, media):
+    """
+    Copy the media files into the collection.media folder.
+    """
+    media_directory = os.path.join(os.path.dirname(col.path), "collection.media")
+    for source_path in media:
+        target_path = os.path.join(media_directory, os.path.basename(source_path))
+        print("Copying media file %s to %s" % (source_path, target_path))
+        col.media.addFile(source_path)
+        #shutil.copyfile(source_path, target_path)
+
+
+def file_digest(path):
+    """
+    Return the SHA-1 of the content of a file.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class MediaIngester:
+    """
+    Copy the media files into the collection.media folder by batches, using a pool of threads.
+    A file already present with the same content is skipped (the sizes are compared first, then the hashes).
+    The files keep their name, so an existing file with a different content is replaced (the old file is removed first
+    and the media folder is marked as changed, so that Anki logs the new content and syncs it).
+    """
+
+    def __init__(self, col, threads=MEDIA_THREADS):
+        self.col = col
+        self.media_directory = col.media.dir()
+        self.pool = multiprocessing.pool.ThreadPool(threads)
+        self.batch = []
+        self.seen = set()
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self.replaced_files = 0
+
+    def add(self, media):
+        for source_path in media:
+            if source_path not in self.seen:
+                self.seen.add(source_path)
+                self.batch.append(source_path)
+        if len(self.batch) >= MEDIA_BATCH_SIZE:
+            self.flush()
+
+    def _ingest(self, source_path):
+        """
+        Copy a single file if needed.
+        :return: a tuple (copied, replaced, size)
+        """
+        target_path = os.path.join(self.media_directory, os.path.basename(source_path))
+        size = os.path.getsize(source_path)
+        replaced = False
+        if os.path.exists(target_path):
+            # The files are only read when the sizes match (the mtimes are not reliable after a copy)
+            if os.path.getsize(target_path) == size and file_digest(target_path) == file_digest(source_path):
+                return (False, False, size)
+            # Anki does not notice a file rewritten in place (the folder mtime is unchanged)
+            os.remove(target_path)
+            replaced = True
+        print("Copying media file %s to %s" % (source_path, target_path))
+        shutil.copyfile(source_path, target_path)
+        return (True, replaced, size)
+
+    def flush(self):
+        for (copied, replaced, size) in self.pool.map(self._ingest, self.batch):
+            if replaced:
+                self.replaced_files += 1
+            if copied:
+                self.copied_files += 1
+                self.copied_bytes += size
+            else:
+                self.skipped_files += 1
+                self.skipped_bytes += size
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.pool.close()
+        self.pool.join()
+        if self.replaced_files:
+            # Force Anki to scan the media folder for changes on the next check or sync
+            self.col.media.db.execute("update meta set dirMod = 0")
+            self.col.media.db.commit()
+        print("Media: %d files copied (%.1f MB), %d files skipped (%.1f MB)" % (
+            self.copied_files, self.copied_bytes / 1048576.0, self.skipped_files, self.skipped_bytes / 1048576.0))
+
+
+def word_tags(word):
+    return "word word-" + str((word.rank() + 1000) // 1000) + '000'
+
+
+def load(col, filepath, deck_name):
+    """
+    Load a single word into Anki. Read the dictionary entry file and try to load the picture and the sound in the same folder if present.
+    :param col: the Anki collection reference
+    :param filepath: the file path of the JSON document file
+    :param deck_name: the name of the Deck to use
+    """
+
+    (word, fields, media) = read_fields(filepath)
+    add_media(col, media)
+    add_note(col, deck_name, word, fields)
+
+
+def add_note(col, deck_name, word, fields):
+    """
+    Add a single note (see read_fields()).
+    """
+
+    # Get the deck
+    deck = col.decks.byName(deck_name)
 
-        # Get the deck
-        deck = col.decks.byName(deck_name)
+    # Instantiate the new note
+    note = col.newNote()
+    note.model()['did'] = deck['id']
 
-        # Instantiate the new note
-        note = col.newNote()
-        note.model()['did'] = deck['id']
+    for field, value in fields.items():
+        note.fields[ANKI_FIELDS.index(field)] = value
 
-        # Ordered fields as defined in Anki note type
-        anki_fields = ["Word", "Sound", "DefinitionsWithSamples", "DefinitionsOnly", "Image", "IPA", "Translation", "Synonyms", "SampleA", "SampleB", "SampleC", "HasImageCard", "HasDefinitionsCard", "AnswerA", "AnswerB", "AnswerC", "HasTranslationCard", "DefinitionA", "DefinitionB", "Rank", "Types" ]
+    # Set the tags (and add the new ones to the deck configuration
+    tags = word_tags(word)
+    note.tags = col.tags.canonify(col.tags.split(tags))
+    m = note.model()
+    m['tags'] = note.tags
+    col.models.save(m)
 
+    # Add the note
+    col.addNote(note)
+
+
+class BulkLoader:
+    """
+    Load many words at once. Unlike load(), the deck, the note type and the tags are resolved only once,
+    the note type is saved only once, and all the notes are added in the same transaction (committed by close()).
+
+    In upsert mode, the existing notes are indexed by word once. A note whose fields did not change is skipped,
+    a note whose fields changed is updated in place, and only the new words are added.
+    """
+
+    def __init__(self, col, deck_name, upsert=False):
+        self.col = col
+        self.model = col.models.byName('Word')
+        self.model['did'] = col.decks.byName(deck_name)['id']
+        self.field_indexes = dict((field, index) for (index, field) in enumerate(ANKI_FIELDS))
+        self.tags = {}  # tags string => canonified tags
+        self.last_tags = None
+        self.count = 0
+        self.added = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.existing = self._index() if upsert else None
+
+    def _index(self):
+        """
+        Return the existing notes of the note type as a dict: word => (note id, hash of the fields).
+        """
+        index = {}
+        for (nid, flds) in self.col.db.all("select id, flds from notes where mid = ?", self.model['id']):
+            word = flds.split("\x1f")[self.field_indexes["Word"]]
+            # Keep the first note if the word was loaded several times
+            if word not in index:
+                index[word] = (nid, self._hash(flds))
+        print("%d existing notes" % len(index))
+        return index
+
+    def _hash(self, flds):
+        return hashlib.sha1(flds.encode('utf-8')).hexdigest()
+
+    def add(self, word, fields):
+        """
+        Add a note (see read_fields()), or update it in upsert mode.
+        """
+        values = [""] * len(ANKI_FIELDS)
         for field, value in fields.items():
-            note.fields[anki_fields.index(field)] = value
+            values[self.field_indexes[field]] = value
+
+        tags = word_tags(word)
+        if tags not in self.tags:
+            self.tags[tags] = self.col.tags.canonify(self.col.tags.split(tags))
+        self.last_tags = self.tags[tags]
+        self.count += 1
+
+        if self.existing is not None:
+            digest = self._hash("\x1f".join(values))
+            if word.title() in self.existing:
+                (nid, existing_digest) = self.existing[word.title()]
+                if digest == existing_digest:
+                    self.unchanged += 1
+                    return
+
+                print("Updating note %s" % word.title())
+                note = self.col.getNote(nid)
+                note.fields = values
+                note.tags = list(self.tags[tags])
+                note.flush()
+                self.existing[word.title()] = (nid, digest)
+                self.updated += 1
+                return
+
+        note = Note(self.col, self.model)
+        note.fields = values
+        note.tags = list(self.tags[tags])
+        self.col.addNote(note)
+        if self.existing is not None:
+            self.existing[word.title()] = (note.id, digest)
+        self.added += 1
+
+    def close(self):
+        """
+        Save the note type (with the last used tags) and commit the transaction.
+        """
+        if self.last_tags is not None:
+            self.model['tags'] = self.last_tags
+            self.col.models.save(self.model)
+        self.col.save()
+        if self.existing is not None:
+            print("%d notes added, %d updated, %d unchanged" % (self.added, self.updated, self.unchanged))
 
-        # Set the tags (and add the new ones to the deck configuration
-        tags = "word word-" + str((word.rank() + 1000) // 1000) + '000'
-        note.tags = col.tags.canonify(col.tags.split(tags))
-        m = note.model()
-        m['tags'] = note.tags
-        col.models.save(m)
 
-        # Add the note
-        col.addNote(note)
+def load_all(col, filepaths, deck_name, bulk=False, jobs=1, upsert=False):
+    """
+    Load the words into Anki. The files are read by the parsing processes
+    while the current process adds the notes in rank order. The media files are copied by a MediaIngester.
+    :param bulk: use a BulkLoader instead of add_note()
+    :param jobs: the number of processes reading the files
+    :param upsert: update the existing notes instead of adding duplicates (implies bulk)
+    :return: the number of loaded notes
+    """
+    ingester = MediaIngester(col)
+
+    if not bulk and not upsert:
+        count = 0
+        for (word, fields, media) in iter_fields(filepaths, jobs):
+            ingester.add(media)
+            add_note(col, deck_name, word, fields)
+            count += 1
+        ingester.close()
+        return count
+
+    loader = BulkLoader(col, deck_name, upsert)
+    for (word, fields, media) in iter_fields(filepaths, jobs):
+        ingester.add(media)
+        loader.add(word, fields)
+    ingester.close()
+    loader.close()
+    return loader.count
+
+
+class Manifest:
+    """
+    Persisted index of the word files present in the save folder (rank, title, path and mtime).
+    The folder is only listed again when its mtime changes (a file was added, renamed or removed).
+    The files are then selected by rank using the index, and only the selected files are checked for changes.
+    """
+
+    WORD_FILE = re.compile(r'^([1-9][0-9]*)-(.+)\.json$')
+
+    def __init__(self, folder, filename):
+        self.folder = folder
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS file (path TEXT PRIMARY KEY, rank INTEGER, title TEXT, mtime REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS file_rank ON file (rank)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS folder (path TEXT PRIMARY KEY, mtime REAL)")
+
+    def refresh(self):
+        """
+        Add the new files and remove the deleted ones if the folder changed since the last run.
+        """
+        folder = os.path.abspath(self.folder)
+        mtime = os.stat(folder).st_mtime
+        row = self.db.execute("SELECT mtime FROM folder WHERE path = ?", (folder,)).fetchone()
+        if row and row[0] == mtime:
+            return
+
+        known = dict(self.db.execute("SELECT path, mtime FROM file"))
+        added = 0
+        updated = 0
+        for filename in os.listdir(folder):
+            m = self.WORD_FILE.match(filename)
+            if not m:
+                continue
+            path = os.path.join(folder, filename)
+            file_mtime = known.pop(path, None)
+            if file_mtime is None:
+                added += 1
+            elif file_mtime != os.stat(path).st_mtime:
+                updated += 1
+            else:
+                continue
+            self._update(path, int(m.group(1)), m.group(2))
+
+        # Remaining files were removed
+        self.db.executemany("DELETE FROM file WHERE path = ?", [(path,) for path in known])
+        self.db.execute("INSERT OR REPLACE INTO folder (path, mtime) VALUES (?, ?)", (folder, mtime))
+        self.db.commit()
+        print("Manifest: %d files added, %d updated, %d removed" % (added, updated, len(known)))
+
+    def _update(self, path, rank, title):
+        self.db.execute("INSERT OR REPLACE INTO file (path, rank, title, mtime) VALUES (?, ?, ?, ?)",
+                        (path, rank, title, os.stat(path).st_mtime))
+
+    def select(self, start, end):
+        """
+        Return the files whose rank is in the range [start, end[, sorted by rank.
+        """
+        filepaths = []
+        rows = self.db.execute("SELECT path, rank, title, mtime FROM file WHERE rank >= ? AND rank < ? ORDER BY rank",
+                               (start, end)).fetchall()
+        for (path, rank, title, mtime) in rows:
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    self._update(path, rank, title)
+            except OSError:
+                # Removed since the last refresh
+                self.db.execute("DELETE FROM file WHERE path = ?", (path,))
+                continue
+            filepaths.append(path)
+        self.db.commit()
+        return filepaths
+
+    def close(self):
+        self.db.close()
+
+
+def benchmark_fields(filepaths, repeat=5):
+    """
+    Measure the rendering of each field of the Word class over the given files.
+    The files are decoded once before the measures.
+    """
+    docs = []
+    for filepath in filepaths:
+        with open(filepath, 'r') as f:
+            docs.append(json.load(f))
+
+    total = 0
+    for renderer in Word.RENDERERS:
+        best = None
+        for i in range(repeat):
+            # New instances so that nothing is reused between the runs
+            words = [Word(doc) for doc in docs]
+            start = time.time()
+            for word in words:
+                getattr(word, renderer)()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        total += best
+        print("%-26s %8.1f ms (%.0f words/sec)" % (renderer, best * 1000, len(docs) / best if best else 0))
+    print("%-26s %8.1f ms (%.0f words/sec)" % ("total", total * 1000, len(docs) / total if total else 0))
+
+
+def open_collection(cpath, deck_name):
+    """
+    Open the Anki collection and select the deck and the note type 'Word' for the new notes.
+    """
+    col = Collection(cpath, log=True)
+
+    # Set the model
+    modelBasic = col.models.byName('Word')
+    deck = col.decks.byName(deck_name)
+    col.decks.select(deck['id'])
+    col.decks.current()['mid'] = modelBasic['id']
+
+    return col
+
+
+def benchmark(anki_home, filepaths, deck_name, jobs=1):
+    """
+    Compare the per-note path with the bulk path. Each one loads the words into a temporary copy of the collection.
+    """
+    for bulk in [False, True]:
+        directory = tempfile.mkdtemp(prefix="anki-benchmark-")
+        try:
+            shutil.copyfile(os.path.join(anki_home, "collection.anki2"), os.path.join(directory, "collection.anki2"))
+            col = open_collection(os.path.join(directory, "collection.anki2"), deck_name)
+            start = time.time()
+            count = load_all(col, filepaths, deck_name, bulk, jobs)
+            col.save()
+            elapsed = time.time() - start
+            col.close()
+            print("%s: %d notes in %.2fs (%.0f notes/sec)" % ("bulk" if bulk else "per-note", count, elapsed, count / elapsed))
+        finally:
+            shutil.rmtree(directory)
 
 
 
 
 if __name__ == '__main__':
 
-    import argparse, glob
+    import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument("anki_home", help="Home of your Anki installation")
     parser.add_argument("-d", "--deck", help="Name of the deck in which to create the flashcards", default="English")
     parser.add_argument("-f", "--folder", help="Input folder where to search files", default="../save")
+    parser.add_argument("-m", "--manifest", help="Manifest of the input folder (default: <folder>.manifest.db)")
     parser.add_argument("--rank", help="Rank of the word to load", type=int)
     parser.add_argument("--from", help="Rank of the first word to load", type=int, default=0, dest="start")  # reserved word
     parser.add_argument("--to", help="Rank of the last word to load", type=int, default=100000, dest="end")  # to be consistent with start
+    parser.add_argument("-b", "--bulk", help="Add all the notes in a single transaction", action='store_true')
+    parser.add_argument("-u", "--upsert", help="Update the notes already loaded instead of adding duplicates (implies --bulk)", action='store_true')
+    parser.add_argument("-j", "--jobs", help="Number of processes to read the files (0 = one per core)",
+                        type=int, default=1)
+    parser.add_argument("--benchmark", help="Compare the per-note and bulk paths on copies of the collection", action='store_true')
+    parser.add_argument("--benchmark-fields", help="Measure the rendering of each field over the selected files", action='store_true')
     parser.add_argument("-v", "--verbose", help="Enable verbose mode", action='store_true')
     parser.set_defaults(verbose=False)
     args = parser.parse_args()
 
+    jobs = args.jobs or multiprocessing.cpu_count()
+
     print("----------------------------------")
     print("Word Loader ----------------------")
     print("----------------------------------")
@@ -333,41 +756,42 @@ if __name__ == '__main__':
 
 
 
-    # Load the anki collection
-    cpath = os.path.join(args.anki_home, "collection.anki2")
-    col = Collection(cpath, log=True)
-
-    # Set the model
-    modelBasic = col.models.byName('Word')
-    deck = col.decks.byName(args.deck)
-    col.decks.select(deck['id'])
-    col.decks.current()['mid'] = modelBasic['id']
-
+    # Select the files using the manifest of the input folder
+    manifest = Manifest(args.folder, args.manifest or os.path.normpath(args.folder) + ".manifest.db")
+    manifest.refresh()
 
     if args.rank:
 
         # Only one word to load
         print("Only rank %d to load" % args.rank)
-        glob_pattern = "%d-*.json" % args.rank
-        file_pattern = os.path.join(args.folder, glob_pattern)
-        print("File pattern: " + file_pattern)
-        for filepath in glob.iglob(file_pattern):
-            load(col, filepath, args.deck)
+        filepaths = manifest.select(args.rank, args.rank + 1)
 
     else:
 
-        # Iterate over input folder
-        glob_pattern = '[1-9]*-*.json'
+        filepaths = manifest.select(args.start, args.end)
+        if args.verbose:
+            print("%d files between ranks %d and %d" % (len(filepaths), args.start, args.end))
 
-        file_pattern = os.path.join(args.folder, glob_pattern)
-        for filepath in glob.iglob(file_pattern):
-            filename = os.path.basename(filepath)
-            rank = int(filename[:filename.index('-')])
-            if rank >= args.start and rank < args.end:
-                load(col, filepath, args.deck)
-            elif args.verbose:
-                print("Skipped %s" % filename)
+    manifest.close()
 
+    if args.benchmark_fields:
+        benchmark_fields(filepaths)
+        sys.exit(0)
+
+    # Load the anki collection
+    cpath = os.path.join(args.anki_home, "collection.anki2")
+
+    if args.benchmark:
+        benchmark(args.anki_home, filepaths, args.deck, jobs)
+        sys.exit(0)
+
+    col = open_collection(cpath, args.deck)
+
+    start = time.time()
+    count = load_all(col, filepaths, args.deck, args.bulk, jobs, args.upsert)
 
     # Save the changes to DB
     col.save()
+
+    elapsed = time.time() - start
+    print("%d notes loaded in %.2fs (%.0f notes/sec)" % (count, elapsed, count / elapsed if elapsed else 0))